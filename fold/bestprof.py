@@ -5,7 +5,11 @@ Parse PRESTO bestprof files.
 import sys
 import re
 import os
+import tarfile
 import traceback
+import zipfile
+
+import numpy
 
 def float_with_error(chunk):
     if chunk == 'N/A':
@@ -63,23 +67,103 @@ KEY_VALUE_MAPPING = {
     'T_peri' : ['t_peri', str],
 }
 
+HEADER_DELIMITER = '#################'
+DELIMITER_REGEXP = re.compile(r'^#.#{17}[^\n]*(\n|$)', re.M)
+
+
 class Header(object):
     pass
 
+
+def parse_header_line(header, line, verbose=False):
+    '''
+    Set the attribute on header for a single header line.
+
+    Returns False if line is the delimiter between header and profile.
+    '''
+    key = line[2:19].strip()
+    value = line[20:].strip()
+    if key == HEADER_DELIMITER:
+        return False
+
+    if key not in KEY_VALUE_MAPPING:
+        if verbose:
+            print 'Unkown header keyword %s' % key
+        return True
+    try:
+        setattr(header, KEY_VALUE_MAPPING[key][0],
+            KEY_VALUE_MAPPING[key][1](value))
+    except Exception, e:
+        if verbose:
+            print 'Conversion failed %s' % line
+            print 'Key:', key
+            print 'Value:', value
+            traceback.print_exc(file=sys.stdout)
+        setattr(header, KEY_VALUE_MAPPING[key][0], None)
+    return True
+
+
+def read_header(filename, verbose=False, data=None):
+    '''
+    Read only the header of a .bestprof file, returns a Header instance.
+
+    Reading stops at the delimiter between header and profile.
+    '''
+    header = Header()
+    if data is None:
+        with open(filename, 'r') as f:
+            for line in f:
+                if line[:1] == '#' and \
+                        not parse_header_line(header, line, verbose):
+                    break
+    else:
+        m = DELIMITER_REGEXP.search(data)
+        if m is not None:
+            data = data[:m.start()]
+        for line in data.splitlines():
+            if line[:1] == '#':
+                parse_header_line(header, line, verbose)
+    return header
+
+
 class BestprofFile(object):
-    def __init__(self, filename, verbose=False):
+    def __init__(self, filename, verbose=False, vectorized=False,
+                 dtype=numpy.float64, data=None, headers_only=False):
         '''
         Class to represent a PRESTO prepfold .bestprof file.
+
+        With vectorized=True the profile is read straight into a NumPy array
+        of the given dtype (much faster, the profile is then an ndarray
+        instead of a list). Pass the file contents as data if they were
+        already read, filename is then only used for bookkeeping. With
+        headers_only=True reading stops at the end of the header and the
+        profile is None.
         '''
-        header, profile = self.parse(filename, verbose)
+        if headers_only:
+            header, profile = read_header(filename, verbose, data), None
+        else:
+            if data is None:
+                with open(filename, 'r') as f:
+                    data = f.read()
+            if vectorized:
+                try:
+                    header, profile = self.parse_vectorized(data, verbose,
+                                                            dtype)
+                except Exception:
+                    # The line parser skips lines it cannot deal with, fall
+                    # back to it so that the same files load either way.
+                    header, profile = self.parse(data, verbose)
+                    profile = numpy.array(profile, dtype=dtype)
+            else:
+                header, profile = self.parse(data, verbose)
         self.filename = os.path.abspath(filename)
         self.header = header
         self.profile = profile
         self.psr_name = ''
 
-    def parse(self, filename, verbose):
+    def parse(self, data, verbose):
         '''
-        Parse the actual .bestprof file.
+        Parse the contents of the actual .bestprof file.
         '''
         tmp_profile = []
         profile = []
@@ -87,60 +171,176 @@ class BestprofFile(object):
         tmp_header = Header()
         in_header = True
 
-        with open(filename, 'r') as f:
-            for line in f:
-                if in_header == True and line[0] == '#':
-                    key = line[2:19].strip()
-                    value = line[20:].strip()
-                    if key == '#################':
-                        in_header = False
-                        continue
-
-                    if key not in KEY_VALUE_MAPPING:
-                        if verbose:
-                            print 'Unkown header keyword %s' % key
-                        continue
-                    try:
-                        setattr(tmp_header, KEY_VALUE_MAPPING[key][0],
-                            KEY_VALUE_MAPPING[key][1](value))
-                    except Exception, e:
-                        if verbose:
-                            print 'Conversion failed %s' % line
-                            print 'Key:', key
-                            print 'Value:', value
-                            traceback.print_exc(file=sys.stdout)
-                        setattr(tmp_header, KEY_VALUE_MAPPING[key][0], None)
-                    else:
-                        pass
-                else:
-                    split_line = line.split()
-                    if len(split_line) != 2:
-                        if verbose:
-                            print 'Can\'t deal with %s' % line
-                    try:
-                        bin_i = int(split_line[0])
-                        value = float(split_line[1])
-                    except ValueError, e:
-                        if verbose:
-                            print 'Can\'t deal with %s' % line
-                    else:
-                        tmp_profile.append((bin_i, value))
-            last_bin_i = -1
-            for bin_i, value in tmp_profile:
-                if last_bin_i + 1 != bin_i:
-                    raise Exception('Profile contains non consequetive values.')
+        for line in data.splitlines(True):
+            if in_header == True and line[0] == '#':
+                in_header = parse_header_line(tmp_header, line, verbose)
+            else:
+                split_line = line.split()
+                if len(split_line) != 2:
+                    if verbose:
+                        print 'Can\'t deal with %s' % line
+                try:
+                    bin_i = int(split_line[0])
+                    value = float(split_line[1])
+                except ValueError, e:
+                    if verbose:
+                        print 'Can\'t deal with %s' % line
                 else:
-                    profile.append(value)
-                last_bin_i = bin_i
+                    tmp_profile.append((bin_i, value))
+        last_bin_i = -1
+        for bin_i, value in tmp_profile:
+            if last_bin_i + 1 != bin_i:
+                raise Exception('Profile contains non consequetive values.')
+            else:
+                profile.append(value)
+            last_bin_i = bin_i
 
-            if not len(profile) == tmp_header.profile_bins:
-                raise Exception('Discrepancy between number of bins according to header and length of profile.')
+        if not len(profile) == tmp_header.profile_bins:
+            raise Exception('Discrepancy between number of bins according to header and length of profile.')
 
-            return tmp_header, profile
+        return tmp_header, profile
+
+    def parse_vectorized(self, data, verbose, dtype=numpy.float64):
+        '''
+        Parse the contents of the .bestprof file, reading the profile with
+        NumPy.
+        '''
+        tmp_header = Header()
+        m = DELIMITER_REGEXP.search(data)
+        if m is None:
+            raise Exception('No delimiter between header and profile.')
+        for line in data[:m.start()].splitlines():
+            if line[:1] == '#':
+                parse_header_line(tmp_header, line, verbose)
+
+        try:
+            values = numpy.array(data[m.end():].split(), dtype=numpy.float64)
+            values = values.reshape(-1, 2)
+        except ValueError:
+            raise Exception('Profile is not made up of (bin, value) pairs.')
+        if not (values[:, 0] == numpy.arange(values.shape[0])).all():
+            raise Exception('Profile contains non consequetive values.')
+
+        if not values.shape[0] == tmp_header.profile_bins:
+            raise Exception('Discrepancy between number of bins according to header and length of profile.')
+
+        return tmp_header, values[:, 1].astype(dtype)
 
     def set_psr_name(self, psr_name):
         self.psr_name = psr_name
 
+
+def is_archive(path):
+    '''
+    Check whether path is a (possibly compressed) tar or a zip archive.
+    '''
+    return os.path.isfile(path) and \
+        (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def iter_archive(path):
+    '''
+    Yield (member name, contents) for the files in a tar or zip archive.
+
+    Tar archives (also compressed ones) are read as a stream, members are
+    never extracted to disk.
+    '''
+    if zipfile.is_zipfile(path):
+        zf = zipfile.ZipFile(path)
+        try:
+            for info in zf.infolist():
+                if not info.filename.endswith('/'):
+                    yield info.filename, zf.read(info)
+        finally:
+            zf.close()
+    else:
+        tf = tarfile.open(path, 'r|*')
+        try:
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member).read()
+                # Do not keep every TarInfo of a large archive around.
+                tf.members = []
+        finally:
+            tf.close()
+
+
+def parse_archive(path, verbose=False, vectorized=True, dtype=numpy.float64):
+    '''
+    Parse the .bestprof files in a tar or zip archive, yields BestprofFile
+    instances.
+    '''
+    for name, data in iter_archive(path):
+        if name.endswith('.bestprof'):
+            yield BestprofFile(os.path.join(path, name), verbose, vectorized,
+                               dtype, data)
+
+
+def _header_columns():
+    '''
+    Return (column name, header attribute, index, dtype) for the columns of
+    a header table, index picks the value or error from (value, error)
+    tuples.
+    '''
+    columns = []
+    for attr, conversion in sorted(KEY_VALUE_MAPPING.values()):
+        if conversion is float_with_error:
+            columns.append((attr, attr, 0, numpy.float64))
+            columns.append((attr + '_err', attr, 1, numpy.float64))
+        elif conversion is prob_parser:
+            columns.append((attr, attr, 0, numpy.float64))
+            columns.append((attr + '_sigma', attr, 1, numpy.float64))
+        elif conversion in (float, int):
+            columns.append((attr, attr, None, numpy.float64))
+        else:
+            columns.append((attr, attr, None, object))
+    return columns
+
+HEADER_COLUMNS = _header_columns()
+
+
+def header_table(headers, filenames=None):
+    '''
+    Turn a list of Header instances into a dict of column arrays.
+
+    Numeric header values become float64 arrays (NaN where a value is
+    missing or could not be parsed), strings become object arrays.
+    '''
+    table = {}
+    if filenames is not None:
+        table['filename'] = numpy.array(filenames, dtype=object)
+    for name, attr, index, dtype in HEADER_COLUMNS:
+        values = []
+        for header in headers:
+            value = getattr(header, attr, None)
+            if index is not None and value is not None:
+                value = value[index]
+            if value is None and dtype is not object:
+                value = numpy.nan
+            values.append(value)
+        table[name] = numpy.array(values, dtype=dtype)
+    return table
+
+
+def scan_headers(directory, suffix='.bestprof', verbose=False):
+    '''
+    Read the headers of all .bestprof files in a directory, returns a dict
+    of column arrays (see header_table) sorted by filename.
+    '''
+    filenames = sorted(f for f in os.listdir(directory) if f.endswith(suffix))
+    headers = [read_header(os.path.join(directory, f), verbose)
+               for f in filenames]
+    return header_table(headers, filenames)
+
+
+def parse_many(filenames, verbose=False, vectorized=True,
+               dtype=numpy.float64):
+    '''
+    Parse a batch of .bestprof files, returns a list of BestprofFile.
+    '''
+    return [BestprofFile(filename, verbose, vectorized, dtype)
+            for filename in filenames]
+
 if __name__ == '__main__':
 
     import brp
@@ -0,0 +1,61 @@
+'''
+Caching of results that only change when candidates or tags change.
+
+Cache keys include the data generation (see models.DataGeneration) so that
+loading folds or tagging candidates invalidates everything at once.
+'''
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+
+from models import DataGeneration
+
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def constraint_signature(get_pars, ignore=('order',)):
+    '''
+    Return a normalized string for a set of (already checked) constraints,
+    parameters that do not influence the selection are left out.
+    '''
+    # Only the last value of a repeated parameter is used (get_pars[k], as
+    # in BestprofManager.with_constraints).
+    items = sorted((k, values[-1]) for k, values in get_pars.iterlists()
+                   if k not in ignore and values)
+    return '&'.join('%s=%s' % (k, v) for k, v in items).encode('utf-8')
+
+
+def cache_key(kind, signature, generation=None):
+    if generation is None:
+        generation = DataGeneration.objects.current()
+    return 'fold:%s:%d:%s' % (kind, generation,
+                              hashlib.md5(signature).hexdigest())
+
+
+def cached_count(qs, signature):
+    '''
+    Return qs.count(), cached per constraint signature and data generation.
+    '''
+    key = cache_key('count', signature)
+    count = cache.get(key)
+    if count is None:
+        count = qs.count()
+        cache.set(key, count, CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    '''
+    Paginator that gets the number of candidates from cached_count.
+    '''
+    def __init__(self, object_list, per_page, signature='', **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page,
+                                                   **kwargs)
+        self.signature = signature
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = cached_count(self.object_list, self.signature)
+        return self._count
+    count = property(_get_count)
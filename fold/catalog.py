@@ -0,0 +1,222 @@
+'''
+Columnar export and import of candidate catalogs.
+
+A catalog holds one array per Bestprof field (see catalog_fields), the
+names of the stored .bestprof and .png files, the pulse profiles (all
+concatenated, with offsets per candidate) and the tags (candidate index and
+tag name index per tag). It is written either as a compressed .npz file or
+as a directory of .npy files, the latter can be memory-mapped when it is
+loaded again.
+
+Only the database rows are exported, the stored files themselves have to
+be copied separately (the same names are used on import).
+'''
+import os
+
+import numpy
+from django.db import transaction
+from django.db.models import FloatField, IntegerField
+
+from models import Bestprof, FoldedImage, CandidateTag, BeamSummary
+from models import DataGeneration, pack_profile, unpack_profile
+from columns import iter_chunks
+import tiles
+
+CATALOG_VERSION = 1
+CHUNK_SIZE = 10000
+# The .bestprof file name is stored as bestprof_file, numpy.savez takes the
+# file argument itself.
+RENAMED = {'file': 'bestprof_file'}
+
+
+def catalog_fields():
+    '''
+    Return the (name, dtype) of the Bestprof fields stored in a catalog.
+    '''
+    fields = []
+    for field in Bestprof._meta.fields:
+        if field.name in ('id', 'profile_data'):
+            continue
+        if isinstance(field, FloatField):
+            fields.append((field.name, '<f8'))
+        elif isinstance(field, IntegerField):
+            fields.append((field.name, '<i8'))
+        else:
+            # CharField and FileField (the name of the stored file)
+            fields.append((field.name, 'U'))
+    return fields
+
+
+def _array(values, dtype):
+    if dtype == 'U':
+        return numpy.array([unicode(v or '') for v in values], dtype=unicode)
+    return numpy.array(values, dtype=dtype)
+
+
+def export_catalog(qs, path, profiles=True):
+    '''
+    Write the candidates in qs to path (a .npz file, or else a directory),
+    returns the number of candidates written.
+    '''
+    fields = catalog_fields()
+    names = [name for name, _ in fields]
+    chunks = dict((name, []) for name in names + ['pk', 'image'])
+    profile_chunks = []
+    lengths = []
+    tagged = []
+
+    # Read in keyset chunks, the strings (and packed profiles) as they are.
+    dtypes = dict((name, object if dtype == 'U' else dtype)
+                  for name, dtype in fields)
+    dtypes['profile_data'] = object
+    columns = names + (['profile_data'] if profiles else [])
+    for chunk in iter_chunks(qs, columns, CHUNK_SIZE, dtypes):
+        pks = chunk['pk']
+        chunks['pk'].append(pks)
+        for name, dtype in fields:
+            chunks[name].append(_array(chunk[name], dtype))
+        if profiles:
+            for packed in chunk['profile_data']:
+                profile = unpack_profile(packed) if packed else \
+                    numpy.zeros(0, dtype='<f4')
+                profile_chunks.append(profile)
+                lengths.append(len(profile))
+        images = dict(FoldedImage.objects.filter(
+            bestprof__in=pks.tolist()).values_list('bestprof', 'file'))
+        chunks['image'].append(_array([images.get(pk) for pk in
+                                       pks.tolist()], 'U'))
+        tagged.extend(CandidateTag.objects.filter(
+            bestprof__in=pks.tolist()).values_list('bestprof', 'name'))
+
+    arrays = {'version': numpy.array([CATALOG_VERSION])}
+    empty_dtypes = dict(fields, pk='<i8', image='U')
+    for name in chunks:
+        if chunks[name]:
+            values = numpy.concatenate(chunks[name])
+        else:
+            values = _array([], empty_dtypes[name])
+        arrays[RENAMED.get(name, name)] = values
+    pks = arrays.pop('pk')
+
+    arrays['profile_offsets'] = numpy.cumsum([0] + lengths).astype('<i8')
+    if profile_chunks:
+        arrays['profile_values'] = numpy.concatenate(profile_chunks)
+    else:
+        arrays['profile_values'] = numpy.zeros(0, dtype='<f4')
+
+    tag_names = sorted(set(name for _, name in tagged))
+    arrays['tag_names'] = _array(tag_names, 'U')
+    arrays['tag_rows'] = numpy.searchsorted(
+        pks, [pk for pk, _ in tagged]).astype('<i8')
+    arrays['tag_name_index'] = numpy.searchsorted(
+        arrays['tag_names'], [name for _, name in tagged]).astype('<i8')
+
+    if path.endswith('.npz'):
+        numpy.savez_compressed(path, **arrays)
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, values in arrays.iteritems():
+            numpy.save(os.path.join(path, name + '.npy'), values)
+    return len(pks)
+
+
+def load_catalog(path):
+    '''
+    Return a dictionary with the arrays of a catalog, the arrays of a
+    directory catalog are memory-mapped.
+    '''
+    if os.path.isdir(path):
+        arrays = dict((name[:-4], numpy.load(os.path.join(path, name),
+                                             mmap_mode='r'))
+                      for name in os.listdir(path) if name.endswith('.npy'))
+    else:
+        with numpy.load(path) as npz:
+            arrays = dict((name, npz[name]) for name in npz.files)
+    if 'version' not in arrays or int(arrays['version'][0]) > CATALOG_VERSION:
+        raise ValueError('Not a (supported) catalog: %s' % path)
+    return arrays
+
+
+def import_catalog(path, batch_size=1000):
+    '''
+    Load the candidates in a catalog into the database, candidates that are
+    already there (same file_digest) are skipped.
+
+    Returns (number of candidates loaded, number skipped).
+    '''
+    arrays = load_catalog(path)
+    names = [name for name, _ in catalog_fields()]
+    n_rows = len(arrays['file_digest'])
+    offsets = arrays['profile_offsets']
+    row_tags = {}
+    for row, name_index in zip(arrays['tag_rows'].tolist(),
+                               arrays['tag_name_index'].tolist()):
+        row_tags.setdefault(row, []).append(
+            unicode(arrays['tag_names'][name_index]))
+
+    n_loaded = 0
+    beams = set()
+    for start in range(0, n_rows, batch_size):
+        rows = range(start, min(start + batch_size, n_rows))
+        digests = [unicode(arrays['file_digest'][i]) for i in rows]
+        known = set(Bestprof.objects.filter(
+            file_digest__in=[d for d in digests if d]).values_list(
+                'file_digest', flat=True))
+
+        new_bestprofs = []
+        for i, digest in zip(rows, digests):
+            if digest in known:
+                continue
+            values = dict((name, arrays[RENAMED.get(name, name)][i].item())
+                          for name in names)
+            # Folds loaded before there were digests have none.
+            values['file_digest'] = digest or None
+            if values['file_digest'] is None and Bestprof.objects.filter(
+                    beam=values['beam'], file_hash=values['file_hash'],
+                    file_digest=None).exists():
+                continue
+            if len(offsets) > i + 1 and offsets[i + 1] > offsets[i]:
+                values['profile_data'] = pack_profile(
+                    arrays['profile_values'][offsets[i]:offsets[i + 1]])
+            new_bestprofs.append((i, Bestprof(**values)))
+        if not new_bestprofs:
+            continue
+
+        with transaction.commit_on_success():
+            # Rows without digest cannot be found back after a bulk insert.
+            for _, new in new_bestprofs:
+                if new.file_digest is None:
+                    new.save()
+            Bestprof.objects.bulk_create([
+                new for _, new in new_bestprofs if new.file_digest])
+            pks = dict(Bestprof.objects.filter(file_digest__in=[
+                new.file_digest for _, new in new_bestprofs]).values_list(
+                    'file_digest', 'pk'))
+            for _, new in new_bestprofs:
+                if new.file_digest:
+                    new.pk = pks[new.file_digest]
+            FoldedImage.objects.bulk_create([
+                FoldedImage(beam=new.beam, bestprof_id=new.pk,
+                            file=unicode(arrays['image'][i]))
+                for i, new in new_bestprofs if arrays['image'][i]])
+            by_beam = {}
+            for _, new in new_bestprofs:
+                by_beam.setdefault(new.beam, []).append(new)
+            for beam, beam_bestprofs in by_beam.iteritems():
+                tiles.add_candidates(beam, beam_bestprofs)
+
+        by_tag = {}
+        for i, new in new_bestprofs:
+            for name in row_tags.get(i, []):
+                by_tag.setdefault(name, []).append(new.pk)
+        for name, tag_pks in by_tag.iteritems():
+            Bestprof.objects.bulk_tag(name, pks=tag_pks)
+        beams.update(new.beam for _, new in new_bestprofs)
+        n_loaded += len(new_bestprofs)
+
+    for beam in beams:
+        BeamSummary.objects.refresh(beam)
+    if n_loaded:
+        DataGeneration.objects.bump()
+    return n_loaded, n_rows - n_loaded
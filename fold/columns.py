@@ -0,0 +1,148 @@
+'''
+Columnar access to candidate selections.
+
+The plots only need a few columns of every candidate, these are fetched
+with a single values_list query into NumPy arrays instead of instantiating
+a Bestprof for every row (once per column).
+'''
+import itertools
+
+import numpy
+from django.core.urlresolvers import reverse
+from django.db.models import FloatField, IntegerField
+
+from models import Bestprof
+
+# Columns needed for the P-DM and P-chi-square plots.
+SCATTER_COLUMNS = ('pk', 'p_bary', 'best_dm', 'reduced_chi_sq', 'ra_deg',
+                   'dec_deg')
+
+# Number of rows fetched per query by iter_chunks.
+CHUNK_SIZE = 10000
+
+# Placeholder primary key, used to build all detail URLs from one reverse().
+_PK_PLACEHOLDER = 987654321
+
+
+def load_columns(qs, fields):
+    '''
+    Return a dictionary mapping field name to a NumPy array with the values
+    of that field for all rows in qs (pk is an integer array, all other
+    fields are read as float64).
+
+    No model instances are made, but the database driver still fetches all
+    rows of qs at once (Django 1.5 cannot read in chunks from SQLite), so
+    this is for bounded selections such as a page of the scatter plots.
+    Use iter_chunks for selections that can be large.
+    '''
+    rows = qs.values_list(*fields).iterator()
+    values = numpy.fromiter(itertools.chain.from_iterable(rows),
+                            dtype=numpy.float64)
+    values = values.reshape(-1, len(fields))
+    columns = {}
+    for i, field in enumerate(fields):
+        if field == 'pk':
+            columns[field] = values[:, i].astype(numpy.int64)
+        else:
+            columns[field] = values[:, i].copy()
+    return columns
+
+
+def load_column(qs, field, dtype=numpy.float64):
+    '''
+    Return the values of a single field for all rows in qs as a NumPy array,
+    in no particular order.
+    '''
+    # Without the ORDER BY the database does not have to sort the selection.
+    values = qs.order_by().values_list(field, flat=True).iterator()
+    return numpy.fromiter(values, dtype=dtype)
+
+
+def iter_chunks(qs, fields, chunk_size=None, dtypes=None):
+    '''
+    Yield the rows of qs in pk order as dictionaries mapping pk and the
+    fields to NumPy arrays of at most chunk_size (default CHUNK_SIZE) rows.
+    The arrays are float64 (pk int64) unless dtypes maps a field to another
+    dtype.
+
+    All fields of a chunk come from one LIMIT query after the last pk seen,
+    so only one chunk is held in memory (also on backends without chunked
+    reads) and the columns of a chunk always have the same length.
+    '''
+    chunk_size = chunk_size or CHUNK_SIZE
+    dtypes = dtypes or {}
+    qs = qs.order_by('pk')
+    fields = ['pk'] + [field for field in fields if field != 'pk']
+    last = None
+    while True:
+        page = qs if last is None else qs.filter(pk__gt=last)
+        rows = list(page.values_list(*fields)[:chunk_size])
+        if not rows:
+            break
+        chunk = {}
+        for i, field in enumerate(fields):
+            dtype = dtypes.get(field, numpy.int64 if field == 'pk' else
+                               numpy.float64)
+            chunk[field] = numpy.array([row[i] for row in rows], dtype=dtype)
+        yield chunk
+        last = rows[-1][0]
+        if len(rows) < chunk_size:
+            break
+
+
+def select(columns, mask):
+    '''
+    Return the columns with only the rows where mask is True.
+    '''
+    return dict((field, values[mask]) for field, values in columns.items())
+
+
+def detail_links(pks):
+    '''
+    Return the URLs of the candidate detail pages for an array of pks.
+    '''
+    template = reverse('bestprof_detail', args=[_PK_PLACEHOLDER])
+    prefix, suffix = template.split(str(_PK_PLACEHOLDER))
+    return ['%s%d%s' % (prefix, pk, suffix) for pk in pks]
+
+
+def scatter_columns(qs):
+    '''
+    Return the columns for the scatter plots (see SCATTER_COLUMNS), only
+    the candidates with a positive DM are included.
+    '''
+    columns = load_columns(qs, SCATTER_COLUMNS)
+    return select(columns, columns['best_dm'] > 0)
+
+
+# Columnar read API (see views.CandidateColumnsView). A page of candidates
+# is a range of primary keys that is streamed in chunks (see iter_chunks).
+
+def column_dtypes():
+    '''
+    Return a dictionary mapping the names of the numeric Bestprof fields
+    (and pk) to the little-endian NumPy dtype they are sent as.
+    '''
+    dtypes = {'pk': '<i8'}
+    for field in Bestprof._meta.fields:
+        if isinstance(field, FloatField):
+            dtypes[field.name] = '<f8'
+        elif isinstance(field, IntegerField):
+            dtypes[field.name] = '<i8'
+    return dtypes
+
+
+def page_range(qs, after, limit):
+    '''
+    Return (last pk, more rows left) for the page of at most limit rows of
+    qs with a pk larger than after (None for the first page). The last pk
+    is None if fewer than limit rows are left, the page then runs to the
+    end of qs.
+    '''
+    qs = qs.order_by('pk')
+    if after is not None:
+        qs = qs.filter(pk__gt=after)
+    last = list(qs.values_list('pk', flat=True)[limit - 1:limit])
+    if not last:
+        return None, False
+    return last[0], qs.filter(pk__gt=last[0]).exists()
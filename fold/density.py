@@ -0,0 +1,164 @@
+'''
+Binning of candidates on a logarithmic grid, used to plot selections that
+are too large to draw one symbol per candidate.
+'''
+import numpy
+from django.db.models import Max, Min
+from django.http import QueryDict
+
+from columns import iter_chunks
+
+# Number of cells along the period and DM (or chi-square) axes.
+DEFAULT_BINS = (120, 60)
+
+
+def _cell_index(values, edges):
+    # Same convention as numpy.histogram: the last bin includes its right
+    # edge.
+    index = numpy.searchsorted(edges, values, side='right') - 1
+    return numpy.clip(index, 0, len(edges) - 2)
+
+
+def _log_edges(lo, hi, n_bins):
+    # Edges that are regular in log10, the outer edges are lo and hi
+    # themselves (10 ** log10(v) need not give v back exactly).
+    log_lo, log_hi = numpy.log10([lo, hi])
+    if log_lo == log_hi:
+        # Same as numpy.histogram for a single value.
+        log_lo, log_hi = log_lo - 0.5, log_hi + 0.5
+    edges = 10 ** numpy.linspace(log_lo, log_hi, n_bins + 1)
+    edges[0] = min(edges[0], lo)
+    edges[-1] = max(edges[-1], hi)
+    return edges
+
+
+class LogGrid(object):
+    '''
+    Counts (and maxima of a value) on a grid that is regular in log10(x)
+    and log10(y), filled one chunk of candidates at a time.
+
+    The values themselves are compared with the edges, every cell includes
+    its lower edges (and the last cells their upper edges), as the links of
+    cell_link do.
+    '''
+    def __init__(self, x_range, y_range, bins=DEFAULT_BINS, maxima=False):
+        self.x_edges = _log_edges(x_range[0], x_range[1], bins[0])
+        self.y_edges = _log_edges(y_range[0], y_range[1], bins[1])
+        self.counts = numpy.zeros(bins)
+        self.maxima = None
+        if maxima:
+            self.maxima = numpy.empty(bins)
+            self.maxima.fill(-numpy.inf)
+
+    def add(self, x, y, values=None):
+        index = (_cell_index(x, self.x_edges), _cell_index(y, self.y_edges))
+        numpy.add.at(self.counts, index, 1)
+        if self.maxima is not None:
+            numpy.maximum.at(self.maxima, index, values)
+
+    def result(self):
+        return self.x_edges, self.y_edges, self.counts, self.maxima
+
+
+def bin_log2d(x, y, values=None, bins=DEFAULT_BINS):
+    '''
+    Bin the (positive) x and y on a grid that is regular in log10(x) and
+    log10(y), see LogGrid.
+
+    Returns (x_edges, y_edges, counts, maxima), where maxima holds the
+    largest of values in every cell (or is None if no values were given).
+    '''
+    grid = LogGrid((x.min(), x.max()), (y.min(), y.max()), bins,
+                   values is not None)
+    grid.add(x, y, values)
+    return grid.result()
+
+
+def bin_queryset(qs, x_field, y_field, value_field=None, bins=DEFAULT_BINS):
+    '''
+    As bin_log2d for the candidates in qs with positive x_field and y_field,
+    returns None if there are none.
+
+    The ranges come from the database and the candidates are binned one
+    chunk at a time, so memory use does not grow with the selection.
+    '''
+    qs = qs.filter(**{x_field + '__gt': 0, y_field + '__gt': 0})
+    bounds = qs.aggregate(x_lo=Min(x_field), x_hi=Max(x_field),
+                          y_lo=Min(y_field), y_hi=Max(y_field))
+    if bounds['x_lo'] is None:
+        return None
+    grid = LogGrid((bounds['x_lo'], bounds['x_hi']),
+                   (bounds['y_lo'], bounds['y_hi']), bins,
+                   value_field is not None)
+    fields = [x_field, y_field] + ([value_field] if value_field else [])
+    for chunk in iter_chunks(qs, fields):
+        grid.add(chunk[x_field], chunk[y_field],
+                 chunk[value_field] if value_field else None)
+    return grid.result()
+
+
+def log_histogram(qs, field, n_bins):
+    '''
+    Histogram of the positive values of field in qs on n_bins bins that are
+    regular in log10, returns (edges, counts) (edges has n_bins + 1 values).
+
+    The range comes from the database, the counts are accumulated one chunk
+    of rows at a time, so memory use does not grow with the selection.
+    '''
+    qs = qs.filter(**{field + '__gt': 0})
+    bounds = qs.aggregate(lo=Min(field), hi=Max(field))
+    if bounds['lo'] is None:
+        return None, None
+    lo, hi = numpy.log10([bounds['lo'], bounds['hi']])
+    if lo == hi:
+        # Same as numpy.histogram for a single value.
+        lo, hi = lo - 0.5, hi + 0.5
+    edges = numpy.linspace(lo, hi, n_bins + 1)
+    counts = numpy.zeros(n_bins, dtype=numpy.int64)
+    for chunk in iter_chunks(qs, [field]):
+        counts += numpy.histogram(numpy.log10(chunk[field]), edges)[0]
+    return 10 ** edges, counts
+
+
+def iter_cells(x_edges, y_edges, counts, maxima=None):
+    '''
+    Yield (x_lo, x_hi, y_lo, y_hi, count, maximum) for the non empty cells,
+    maximum is None if no maxima are given.
+    '''
+    for i, j in zip(*numpy.nonzero(counts)):
+        maximum = None if maxima is None else float(maxima[i, j])
+        yield (float(x_edges[i]), float(x_edges[i + 1]),
+               float(y_edges[j]), float(y_edges[j + 1]),
+               int(counts[i, j]), maximum)
+
+
+# GET parameters (see BestprofManager.with_constraints) for the bounds of a
+# cell along each axis.
+BOUND_PARAMETERS = {
+    'p_bary': ('lo_p', 'hi_p'),
+    'best_dm': ('lo_dm', 'hi_dm'),
+    'reduced_chi_sq': ('lo_redchisq', 'hi_redchisq'),
+}
+
+
+def cell_link(list_url, selection, x_field, y_field, cell,
+              upper_edges=(None, None)):
+    '''
+    Return the URL of the candidate list constrained to cell (as yielded by
+    iter_cells) on top of the current selection (a query string).
+
+    The upper bounds of a cell are exclusive, so that a candidate on an
+    edge is only linked from one cell, except at upper_edges (the last x
+    and y edges of the grid).
+    '''
+    qd = QueryDict(selection.lstrip('?'), mutable=True)
+    x_lo, x_hi, y_lo, y_hi = cell[:4]
+    for field, lo, hi, upper in [(x_field, x_lo, x_hi, upper_edges[0]),
+                                 (y_field, y_lo, y_hi, upper_edges[1])]:
+        lo_key, hi_key = BOUND_PARAMETERS[field]
+        if hi != upper:
+            # The hi_* constraints are inclusive, use the float just below.
+            hi = float(numpy.nextafter(hi, -numpy.inf))
+        qd[lo_key] = repr(lo)
+        qd[hi_key] = repr(hi)
+    return '%s?%s' % (list_url, qd.urlencode())
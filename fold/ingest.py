@@ -0,0 +1,388 @@
+'''
+Helpers shared by the fold ingestion management commands.
+
+Everything in here that is handed to a worker process must stay at module
+level (so that it can be pickled) and must not touch the database, database
+writes always happen in the parent process.
+'''
+import errno
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+
+import numpy
+from django.db import transaction
+
+import bestprof
+import tiles
+from models import Bestprof, FoldedImage, BeamSummary, DataGeneration
+from models import read_file
+
+BESTPROF_SUFFIX = '.pfd.bestprof'
+PNG_SUFFIX = '.png'
+
+
+def find_folds(in_dir):
+    '''
+    Return sorted basenames of the folds in in_dir that have both a
+    .pfd.bestprof and a .png file.
+    '''
+    bestprof_files = set()
+    png_files = set()
+
+    for f in os.listdir(in_dir):
+        if f.endswith(BESTPROF_SUFFIX):
+            bestprof_files.add(f[:-len(BESTPROF_SUFFIX)])
+        elif f.endswith(PNG_SUFFIX):
+            png_files.add(f[:-len(PNG_SUFFIX)])
+
+    return sorted(bestprof_files.intersection(png_files))
+
+
+def parse_fold(job):
+    '''
+    Read, parse and hash a single .pfd.bestprof file (runs in a worker
+    process).
+
+    Takes a (basename, filename, data) tuple, data are the file contents or
+    None if they still need to be read from filename. Returns a tuple of
+    (basename, BestprofFile instance, file contents, file digest, errno)
+    where the last entry is None unless the file could not be read.
+    '''
+    bn, filename, data = job
+    if data is None:
+        try:
+            data, file_digest = read_file(filename)
+        except IOError, e:
+            return bn, None, None, None, e.errno
+    else:
+        file_digest = hashlib.sha256(data).hexdigest()
+    bpf = bestprof.BestprofFile(filename, vectorized=True,
+                                dtype=numpy.float32, data=data)
+    return bn, bpf, data, file_digest, None
+
+
+def parse_jobs(jobs, workers=1, chunksize=64):
+    '''
+    Run parse_fold over jobs, optionally in a pool of worker processes.
+
+    Results are yielded in the order of jobs regardless of the number of
+    workers, exceptions raised while parsing propagate to the caller. Jobs
+    are handed to the pool in windows so that only a bounded number of them
+    is in memory at any time.
+    '''
+    if workers <= 1:
+        for result in itertools.imap(parse_fold, jobs):
+            yield result
+        return
+
+    jobs = iter(jobs)
+    window_size = workers * chunksize * 4
+    pool = multiprocessing.Pool(workers)
+    try:
+        while True:
+            window = list(itertools.islice(jobs, window_size))
+            if not window:
+                break
+            for result in pool.imap(parse_fold, window, chunksize):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_folds(in_dir, basenames, workers=1, chunksize=64):
+    '''
+    Parse the .pfd.bestprof files in in_dir for basenames, see parse_jobs.
+    '''
+    jobs = ((bn, os.path.join(in_dir, bn + BESTPROF_SUFFIX), None)
+            for bn in basenames)
+    return parse_jobs(jobs, workers, chunksize)
+
+
+def iter_archive_folds(path):
+    '''
+    Stream the folds from a tar or zip archive.
+
+    Yields (basename, .pfd.bestprof member name, its contents, .png member
+    name, its contents) as soon as both halves of a fold were read, only
+    halves that are still waiting for their partner are kept in memory.
+    '''
+    waiting = {}
+    for name, data in bestprof.iter_archive(path):
+        if name.endswith(BESTPROF_SUFFIX):
+            bn, i = name[:-len(BESTPROF_SUFFIX)], 0
+        elif name.endswith(PNG_SUFFIX):
+            bn, i = name[:-len(PNG_SUFFIX)], 1
+        else:
+            continue
+        bn = os.path.basename(bn)
+        halves = waiting.setdefault(bn, [None, None])
+        halves[i] = (name, data)
+        if halves[0] is not None and halves[1] is not None:
+            del waiting[bn]
+            yield (bn,) + halves[0] + halves[1]
+
+
+class BatchWriter(object):
+    '''
+    Write parsed folds to the database in chunks.
+
+    Every chunk is written with two bulk inserts (one for the Bestprof rows
+    and one for their FoldedImage rows) inside a single transaction, so a
+    fold is either loaded completely or not at all. Problems that only
+    affect a single fold are collected in the failures list.
+
+    If given, on_commit is called after every chunk with the .pfd.bestprof
+    filenames of the folds that are now in the database (loaded or already
+    there before).
+
+    A fold can replace an earlier version of itself (see add), the old row
+    is deleted in the same transaction that writes the new one.
+    '''
+    def __init__(self, beam_name, ra_deg, dec_deg, ra, dec, batch_size=200,
+                 on_commit=None):
+        self.beam_name = beam_name
+        self.coordinates = (ra_deg, dec_deg, ra, dec)
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.failures = []
+        self.n_written = 0
+        self._pending = []
+        # Digests already in the database for this beam, the file_digest
+        # column is unique over all beams so flush() looks up the remaining
+        # ones.
+        self._known = set(Bestprof.objects.filter(
+            beam=beam_name).values_list('file_digest', flat=True))
+
+    def add(self, bestprof_file, png_file, bpf, data, file_digest,
+            png_data=None, replaces=None):
+        '''
+        Queue a parsed fold, writes a chunk once batch_size folds are queued.
+
+        The .png file is read from png_file unless its contents are passed
+        as png_data. If replaces is given, the Bestprof with that digest is
+        deleted when (and only when) this fold is written.
+        '''
+        self._pending.append((bestprof_file, png_file, bpf, data,
+                              file_digest, png_data, replaces))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write all queued folds to the database.
+        '''
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        # Files may also have been loaded as part of another beam.
+        digests = [p[4] for p in pending if p[4] not in self._known]
+        if digests:
+            self._known.update(Bestprof.objects.filter(
+                file_digest__in=digests).values_list('file_digest', flat=True))
+        # Databases created before file_digest keep a unique constraint on
+        # file_hash, a fold loaded back then would abort the whole chunk.
+        known_hashes = set(Bestprof.objects.filter(
+            file_hash__in=[hash(p[3]) for p in pending]).values_list(
+                'file_hash', flat=True))
+        self._write(pending, known_hashes)
+
+    def _write(self, pending, known_hashes):
+        ra_deg, dec_deg, ra, dec = self.coordinates
+        failures = []
+        new_bestprofs = []
+        new_images = []
+        replaced = []
+        done = []
+        # Digests written by this chunk, _known only grows after the commit.
+        batch_digests = set()
+        for bestprof_file, png_file, bpf, data, file_digest, png_data, \
+                replaces in pending:
+            if file_digest in self._known or file_digest in batch_digests \
+                    or hash(data) in known_hashes:
+                msg = 'File probably already uploaded: %s' % bestprof_file
+                failures.append(msg)
+                done.append(bestprof_file)
+                continue
+            try:
+                new_image = FoldedImage.objects.create_image(
+                    png_file, self.beam_name, None, data=png_data)
+            except IOError, e:
+                if e.errno == errno.ENOENT:
+                    msg = 'File does not exist: %s' % png_file
+                else:
+                    msg = 'Cannot read %s: %s' % (png_file, e)
+                failures.append(msg)
+                continue
+            if replaces is not None:
+                replaced.append(replaces)
+            new = Bestprof.objects.create_bestprof(
+                bestprof_file, self.beam_name, ra_deg, dec_deg, ra, dec,
+                bpf=bpf, data=data, file_digest=file_digest)
+            batch_digests.add(file_digest)
+            known_hashes.add(hash(data))
+            done.append(bestprof_file)
+            new_bestprofs.append(new)
+            new_images.append((file_digest, new_image))
+
+        with transaction.commit_on_success():
+            if replaced:
+                Bestprof.objects.filter(file_digest__in=replaced).delete()
+            Bestprof.objects.bulk_create(new_bestprofs)
+            # bulk_create does not set primary keys, look them up.
+            pks = dict(Bestprof.objects.filter(
+                file_digest__in=[d for d, _ in new_images]
+            ).values_list('file_digest', 'pk'))
+            for file_digest, new_image in new_images:
+                new_image.bestprof_id = pks[file_digest]
+            FoldedImage.objects.bulk_create(
+                [new_image for _, new_image in new_images])
+            if new_bestprofs:
+                BeamSummary.objects.add_candidates(self.beam_name,
+                                                   new_bestprofs)
+                if not replaced:
+                    tiles.add_candidates(self.beam_name, new_bestprofs)
+                DataGeneration.objects.bump()
+        if replaced:
+            # Deleted candidates cannot be taken out of the tiles.
+            tiles.build_beam_tiles(self.beam_name)
+
+        self.failures.extend(failures)
+        self._known.difference_update(replaced)
+        self._known.update(new.file_digest for new in new_bestprofs)
+        self.n_written += len(new_bestprofs)
+        if self.on_commit is not None:
+            self.on_commit(done)
+
+
+def stored_basename(name):
+    '''
+    Return the fold basename for the name of a stored .pfd.bestprof file
+    (the storage appends _1, _2, ... to names that were already taken).
+    '''
+    bn = os.path.basename(name)
+    if bn.endswith(BESTPROF_SUFFIX):
+        return bn[:-len(BESTPROF_SUFFIX)]
+    return re.sub(r'\.pfd_\d+\.bestprof$', '', bn)
+
+
+class Journal(object):
+    '''
+    Record of the fold basenames of a beam that were loaded.
+
+    Every write is flushed and synced to disk so that the journal never
+    claims more than what was committed to the database.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def completed(self):
+        '''
+        Return the set of basenames recorded in the journal.
+        '''
+        try:
+            with open(self.path) as f:
+                return set(line.rstrip('\n') for line in f if line.strip())
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return set()
+            raise
+
+    def record(self, basenames):
+        if not basenames:
+            return
+        with open(self.path, 'a') as f:
+            f.write(''.join(bn + '\n' for bn in basenames))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self, basenames):
+        '''
+        Drop basenames from the journal (for folds that were removed from
+        the database again), the journal is rewritten atomically.
+        '''
+        basenames = set(basenames)
+        completed = self.completed()
+        if not basenames & completed:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(bn + '\n' for bn in sorted(completed - basenames)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        with open(self.path, 'w'):
+            pass
+
+
+class Manifest(object):
+    '''
+    Record of the folds in a directory that were already ingested.
+
+    For every fold basename the manifest keeps the (size, mtime) of both the
+    .pfd.bestprof and .png files and the digest of the .pfd.bestprof file.
+    It is stored as JSON and written atomically.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, bn):
+        return bn in self.entries
+
+    def is_current(self, bn, bestprof_stat, png_stat):
+        '''
+        Check whether the fold is in the manifest with the same size and
+        mtime for both files.
+        '''
+        try:
+            entry = self.entries[bn]
+        except KeyError:
+            return False
+        return (tuple(entry['bestprof']) == bestprof_stat and
+                tuple(entry['png']) == png_stat)
+
+    def digest(self, bn):
+        return self.entries[bn]['digest']
+
+    def png_changed(self, bn, png_stat):
+        '''
+        Check whether the .png of a fold in the manifest has another size or
+        mtime now.
+        '''
+        return tuple(self.entries[bn]['png']) != png_stat
+
+    def update(self, bn, bestprof_stat, png_stat, digest):
+        self.entries[bn] = {
+            'bestprof': list(bestprof_stat),
+            'png': list(png_stat),
+            'digest': digest,
+        }
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_path, self.path)
+
+
+def stat_file(filename):
+    '''
+    Return (size, mtime) for a file or None if it does not exist.
+    '''
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return st.st_size, st.st_mtime
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from optparse import make_option
+
+import numpy
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from fold import bestprof
+from fold import ingest
+from fold.models import Bestprof, FoldedImage, Tile
+from fold.models import BeamSummary, DataGeneration
+
+
+class Command(BaseCommand):
+    args = '<directory with folds (see makefolds)>'
+    help = 'Measure ingest throughput (files/s) per stage: reading, ' + \
+        'parsing, hashing, database insert and media copy. The folds ' + \
+        'are processed in chunks, only one chunk is kept in memory. ' + \
+        'The insert stage writes (and commits) the folds with the ' + \
+        'loadbeam code to a throwaway beam that is removed afterwards.'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Only use the first LIMIT folds.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=200,
+                    help='Number of rows per bulk insert.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of folds that go through all stages '
+                         'before the next ones are read.'),
+        make_option('--json', action='store_true', dest='json',
+                    default=False,
+                    help='Write the results as a single line of JSON.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args or len(args) != 1:
+            raise CommandError('Specify a directory with folds.')
+        in_dir = os.path.realpath(args[0])
+        basenames = ingest.find_folds(in_dir)
+        if kwargs.get('limit'):
+            basenames = basenames[:kwargs['limit']]
+        if not basenames:
+            raise CommandError('No folds found in: %s' % in_dir)
+        self.batch_size = kwargs.get('batch_size', 200)
+        chunk_size = kwargs.get('chunk_size', 1000)
+        if chunk_size < 1:
+            raise CommandError('Chunk size must be at least 1.')
+
+        n = len(basenames)
+        names = ['read', 'parse', 'parse_text', 'hash', 'insert', 'copy']
+        totals = dict((name, 0.0) for name in names)
+
+        def stage(name, func, *stage_args):
+            t_start = time.time()
+            result = func(*stage_args)
+            totals[name] += time.time() - t_start
+            return result
+
+        # The digests are salted per run, so that the folds are loaded even
+        # if the same files were loaded for real before.
+        self.run_id = uuid.uuid4().hex
+        beam = 'benchmark-' + self.run_id
+        # Every stage is timed per chunk and the timings are added up, the
+        # stored copies are removed (untimed) after every chunk.
+        location = tempfile.mkdtemp()
+        try:
+            storage = FileSystemStorage(location=location)
+            journal = ingest.Journal(os.path.join(location, 'journal'))
+
+            def on_commit(bestprof_files):
+                journal.record([
+                    os.path.basename(f)[:-len(ingest.BESTPROF_SUFFIX)]
+                    for f in bestprof_files])
+            writer = ingest.BatchWriter(beam, 0, 0, '00:00:00', '00:00:00',
+                                        self.batch_size, on_commit)
+            for i in range(0, n, chunk_size):
+                files = stage('read', self.read, in_dir,
+                              basenames[i:i + chunk_size])
+                bpfs = stage('parse', self.parse, files)
+                stage('parse_text', self.parse_text, files)
+                digests = stage('hash', self.hash, files)
+                stage('insert', self.insert, writer, files, bpfs, digests)
+                stored = stage('copy', self.copy, storage, files)
+                for name in stored:
+                    storage.delete(name)
+            if writer.failures:
+                raise CommandError('Problems with: \n%s' %
+                                   '\n'.join(writer.failures))
+        finally:
+            shutil.rmtree(location)
+            self.remove_beam(beam)
+        timings = [(name, totals[name]) for name in names]
+
+        results = {
+            'timestamp': time.time(),
+            'directory': in_dir,
+            'n_folds': n,
+            'database': connection.vendor,
+            'stages': dict((name, {
+                'seconds': seconds,
+                'files_per_second': n / seconds if seconds > 0 else None,
+            }) for name, seconds in timings),
+        }
+        if kwargs.get('json'):
+            self.stdout.write(json.dumps(results, sort_keys=True))
+        else:
+            self.stdout.write('%d folds from %s' % (n, in_dir))
+            for name, seconds in timings:
+                self.stdout.write('%-12s %10.3f s %12.1f files/s' % (
+                    name, seconds, n / seconds if seconds > 0 else 0))
+
+    def read(self, in_dir, basenames):
+        files = []
+        for bn in basenames:
+            bestprof_file = os.path.join(in_dir, bn + ingest.BESTPROF_SUFFIX)
+            png_file = os.path.join(in_dir, bn + ingest.PNG_SUFFIX)
+            with open(bestprof_file, 'rb') as f:
+                data = f.read()
+            with open(png_file, 'rb') as f:
+                png_data = f.read()
+            files.append((bestprof_file, data, png_file, png_data))
+        return files
+
+    def parse(self, files):
+        return [bestprof.BestprofFile(bestprof_file, vectorized=True,
+                                      dtype=numpy.float32, data=data)
+                for bestprof_file, data, _, _ in files]
+
+    def parse_text(self, files):
+        # The original (non-vectorized) parser, for comparison.
+        return [bestprof.BestprofFile(bestprof_file, data=data)
+                for bestprof_file, data, _, _ in files]
+
+    def hash(self, files):
+        return [hashlib.sha256(self.run_id + data).hexdigest()
+                for _, data, _, _ in files]
+
+    def insert(self, writer, files, bpfs, digests):
+        '''
+        Write the folds with ingest.BatchWriter, as loadbeam does.
+        '''
+        for (bestprof_file, data, png_file, png_data), bpf, file_digest in \
+                zip(files, bpfs, digests):
+            writer.add(bestprof_file, png_file, bpf, data, file_digest,
+                       png_data)
+        writer.flush()
+
+    def remove_beam(self, beam):
+        '''
+        Remove everything the insert stage wrote for beam (untimed). Plain
+        SQL, deleting through the ORM would refresh the beam summary once
+        for every fold.
+        '''
+        names = []
+        for model in [Bestprof, FoldedImage]:
+            names.extend(model.objects.filter(beam=beam).values_list(
+                'file', flat=True))
+        cursor = connection.cursor()
+        with transaction.commit_on_success():
+            # The benchmark folds are not tagged.
+            for model in [FoldedImage, Bestprof]:
+                cursor.execute('DELETE FROM %s WHERE beam = %%s' %
+                               model._meta.db_table, [beam])
+            Tile.objects.filter(beam=beam).delete()
+            BeamSummary.objects.filter(beam=beam).delete()
+        DataGeneration.objects.bump()
+        for name in names:
+            default_storage.delete(name)
+        # Also the (now empty) media directory of the beam.
+        try:
+            for directory in set(os.path.dirname(default_storage.path(name))
+                                 for name in names):
+                os.rmdir(directory)
+        except (NotImplementedError, OSError):
+            pass
+
+    def copy(self, storage, files):
+        '''
+        Store copies of the files in storage, returns the stored names.
+        '''
+        stored = []
+        for bestprof_file, data, png_file, png_data in files:
+            stored.append(storage.save(os.path.basename(bestprof_file),
+                                       ContentFile(data)))
+            stored.append(storage.save(os.path.basename(png_file),
+                                       ContentFile(png_data)))
+        return stored
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from fold import tiles
+from fold.models import Bestprof, Tile
+
+
+class Command(BaseCommand):
+    args = '[<beam name> ...]'
+    help = 'Precompute the P-DM map tiles of the given beams (default: all).'
+
+    def handle(self, *args, **kwargs):
+        if args:
+            beams = args
+        else:
+            beams = sorted(set(Bestprof.objects.values_list('beam',
+                                                            flat=True)))
+            # Tiles of beams that no longer have any folds.
+            Tile.objects.exclude(beam__in=beams).delete()
+        for beam in beams:
+            n_tiles = tiles.build_beam_tiles(beam)
+            self.stdout.write('%s: %d tiles' % (beam, n_tiles))
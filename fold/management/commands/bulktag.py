@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from fold.models import Bestprof
+
+
+class Command(BaseCommand):
+    args = '<tag> [<primary key> ...]'
+    help = 'Add (or remove) a tag for the given candidates or for a ' + \
+        'selection (as in the URLs of the site, e.g. "lo_dm=0&hi_dm=2").'
+    option_list = BaseCommand.option_list + (
+        make_option('--remove', action='store_true', dest='remove',
+                    default=False, help='Remove the tag instead.'),
+        make_option('--selection', dest='selection', default=None,
+                    help='Constraints on the candidates as a query string.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Tag all candidates.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of candidates tagged per query.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args:
+            raise CommandError('Specify a tag.')
+        name = args[0]
+        selection = kwargs.get('selection')
+        if args[1:]:
+            if selection or kwargs.get('all'):
+                raise CommandError('Specify either primary keys or a '
+                                   'selection.')
+            try:
+                pks = [int(pk) for pk in args[1:]]
+            except ValueError:
+                raise CommandError('Primary keys must be integers.')
+            qs = None
+        elif selection or kwargs.get('all'):
+            pks = None
+            qs = Bestprof.objects.with_constraints(QueryDict(selection or ''))
+        else:
+            raise CommandError('Specify primary keys, --selection or --all.')
+
+        remove = kwargs.get('remove', False)
+        t_start = time.time()
+        n_changed = Bestprof.objects.bulk_tag(
+            name, qs=qs, pks=pks, remove=remove,
+            batch_size=kwargs.get('batch_size', 500))
+        self.stdout.write('%s tag %s %s %d candidates (%.1f s).' % (
+            'Removed' if remove else 'Added', name,
+            'from' if remove else 'to', n_changed, time.time() - t_start))
@@ -0,0 +1,64 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import QueryDict
+
+from fold.models import Bestprof
+
+EXPLAIN_PREFIX = {
+    'sqlite': 'EXPLAIN QUERY PLAN',
+    'postgresql': 'EXPLAIN',
+    'mysql': 'EXPLAIN',
+}
+
+
+class Command(BaseCommand):
+    args = '[<constraint>=<value> ...]'
+    help = 'Show the query plan for a candidate selection, e.g. ' + \
+        'explainconstraints lo_dm=10 hi_p=5 order=redchisq'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=50,
+                    help='Explain the query for one page of this size ' +
+                         '(0 for the whole selection).'),
+        make_option('--count', action='store_true', dest='count',
+                    default=False,
+                    help='Also explain the COUNT(*) query used for paging.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        get_pars = QueryDict('').copy()
+        for arg in args:
+            try:
+                k, v = arg.split('=', 1)
+            except ValueError:
+                raise CommandError('Constraints look like key=value: %s' %
+                                   arg)
+            get_pars[k] = v
+
+        try:
+            prefix = EXPLAIN_PREFIX[connection.vendor]
+        except KeyError:
+            raise CommandError('Cannot explain queries for database %s' %
+                               connection.vendor)
+
+        qs = Bestprof.objects.with_constraints(get_pars)
+        if kwargs.get('limit'):
+            qs = qs[:kwargs['limit']]
+        self.explain(prefix, qs.query)
+
+        if kwargs.get('count'):
+            qs = Bestprof.objects.with_constraints(get_pars)
+            self.explain(prefix, qs.values('pk').order_by().query,
+                         count=True)
+
+    def explain(self, prefix, query, count=False):
+        sql, params = query.sql_with_params()
+        if count:
+            sql = 'SELECT COUNT(*) FROM (%s) subquery' % sql
+        self.stdout.write(sql % tuple(repr(p) for p in params))
+        cursor = connection.cursor()
+        cursor.execute('%s %s' % (prefix, sql), params)
+        for row in cursor.fetchall():
+            self.stdout.write('    ' + ' '.join(str(c) for c in row))
+        self.stdout.write('')
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from fold import catalog
+from fold.models import Bestprof
+
+
+class Command(BaseCommand):
+    args = '<output .npz file or directory>'
+    help = 'Export candidates (header columns, tags and profiles) to a ' + \
+        'columnar catalog, a compressed .npz file or a directory of ' + \
+        '(memory-mappable) .npy files.'
+    option_list = BaseCommand.option_list + (
+        make_option('--selection', dest='selection', default=None,
+                    help='Constraints on the candidates as a query string '
+                         '(as in the URLs of the site, e.g. "beam=B1").'),
+        make_option('--no-profiles', action='store_false', dest='profiles',
+                    default=True, help='Leave out the pulse profiles.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args or len(args) != 1:
+            raise CommandError('Specify the output file or directory.')
+        qs = Bestprof.objects.with_constraints(
+            QueryDict(kwargs.get('selection') or ''))
+        n_rows = catalog.export_catalog(qs, args[0],
+                                        kwargs.get('profiles', True))
+        self.stdout.write('Exported %d candidates to %s' % (n_rows, args[0]))
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fold import catalog
+
+
+class Command(BaseCommand):
+    args = '<catalog .npz file or directory>'
+    help = 'Load the candidates in a catalog written by exportcatalog, ' + \
+        'candidates that are already loaded are skipped.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of candidates written per transaction.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args or len(args) != 1:
+            raise CommandError('Specify the catalog file or directory.')
+        try:
+            n_loaded, n_skipped = catalog.import_catalog(
+                args[0], kwargs.get('batch_size', 1000))
+        except (IOError, ValueError), e:
+            raise CommandError('Cannot read catalog %s: %s' % (args[0], e))
+        self.stdout.write('Loaded %d candidates, skipped %d already loaded.'
+                          % (n_loaded, n_skipped))
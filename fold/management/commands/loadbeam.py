@@ -1,17 +1,41 @@
 import errno
 import os
 import math
+from optparse import make_option
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db.utils import IntegrityError
-from fold.models import Bestprof, FoldedImage
+from django.db import connection
 
+from fold import bestprof
 from fold import coords
+from fold import ingest
+from fold import tiles
+from fold.models import Bestprof
 
 
 class Command(BaseCommand):
-    args = '<pulpsearch style output search output directory> <beam name> <ra> <dec>'
-    help = 'Load all pulsar folds from search'
+    args = '<pulpsearch style output search output directory or archive> <beam name> <ra> <dec>'
+    help = 'Load all pulsar folds from search (directory, .tar(.gz) or .zip)'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of processes used to parse the .bestprof '
+                         'files (database writes stay in this process).'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=200,
+                    help='Number of folds written per database transaction.'),
+        make_option('--resume', action='store_true', dest='resume',
+                    default=False,
+                    help='Skip the folds that the journal of an earlier '
+                         '(interrupted) run lists as loaded.'),
+        make_option('--journal', dest='journal', default=None,
+                    help='Journal file (defaults to <beam name>.journal in '
+                         'settings.INGEST_JOURNAL_DIR).'),
+        make_option('--cleanup', action='store_true', dest='cleanup',
+                    default=False,
+                    help='First remove folds of this beam that were loaded '
+                         'without their .png file.'),
+    )
 
     def handle(self, *args, **kwargs):
         if not args or len(args) != 4:
@@ -26,68 +50,113 @@ class Command(BaseCommand):
         dec_deg = 180 * dec.to_radians() / math.pi
         self.stdout.write('(RA, DEC) = (%.2f, %.2f)' % (ra_deg, dec_deg))
 
-        # find relevant files
-        in_dir = os.path.realpath(args[0])
-        bestprof_files = set()
-        png_files = set()
+        workers = kwargs.get('workers', 1)
+        if workers < 1:
+            raise CommandError('Number of workers must be at least 1.')
+        batch_size = kwargs.get('batch_size', 200)
+        if batch_size < 1:
+            raise CommandError('Batch size must be at least 1.')
 
-        files = os.listdir(in_dir)
-        for f in files:
-            if f.endswith('.pfd.bestprof'):
-                bestprof_files.add(f[:-13])
-            elif f.endswith('.png'):
-                png_files.add(f[:-4])
+        # find relevant files, either in a directory or in an archive
+        in_path = os.path.realpath(args[0])
+        from_archive = bestprof.is_archive(in_path)
+        if not from_archive:
+            basenames = ingest.find_folds(in_path)
+            if not basenames:
+                raise CommandError('No folds found in: %s' % in_path)
 
-        basenames = bestprof_files.intersection(png_files)
+        removed = []
+        if kwargs.get('cleanup'):
+            removed = self.cleanup(beam_name)
+            if removed:
+                # New folds are merged into the tiles while they are written.
+                tiles.build_beam_tiles(beam_name)
 
-        if not basenames:
-            raise CommandError('No folds found in: %s' % in_dir)
+        journal = self.get_journal(beam_name, kwargs.get('journal'))
+        # The removed folds have to be loaded again when resuming.
+        journal.remove(removed)
+        completed = set()
+        if kwargs.get('resume'):
+            completed = journal.completed()
+            self.stdout.write('Resuming, skipping %d folds already loaded.' %
+                              len(completed))
+        else:
+            journal.clear()
+
+        def on_commit(bestprof_files):
+            journal.record([os.path.basename(f)[:-len(ingest.BESTPROF_SUFFIX)]
+                            for f in bestprof_files])
+
+        # .png contents (for archives) of the folds that are being parsed
+        png_data = {}
+
+        def archive_jobs():
+            for bn, bestprof_name, data, png_name, png in \
+                    ingest.iter_archive_folds(in_path):
+                if bn in completed:
+                    continue
+                png_data[bn] = png
+                yield bn, os.path.join(in_path, bestprof_name), data
+
+        if from_archive:
+            jobs = archive_jobs()
+        else:
+            jobs = ((bn, os.path.join(in_path, bn + ingest.BESTPROF_SUFFIX),
+                     None) for bn in basenames if bn not in completed)
 
         failures = []
-        for bn in basenames:
-            bestprof_file = os.path.join(in_dir, bn + '.pfd.bestprof')
-            png_file = os.path.join(in_dir, bn + '.png')
-
-            assert os.path.exists(bestprof_file)
-            assert os.path.exists(png_file)
-
-            try:
-                new = Bestprof.objects.create_bestprof(
-                    bestprof_file, beam_name, ra_deg, dec_deg, ra, dec
-                )
-            except IOError, e:
-                if e.errno == errno.ENOENT:
-                    msg = 'File does not exist: %s' % bestprof_file
-                    failures.append(msg)
-            except:
-                raise
-            else:
-                try:
-                    new.save()
-                except IntegrityError:
-                    msg = 'File probably already uploaded: %s' % bestprof_file
+        writer = ingest.BatchWriter(beam_name, ra_deg, dec_deg, ra, dec,
+                                    batch_size, on_commit)
+        if workers > 1:
+            # Do not share the database connection with the worker processes.
+            connection.close()
+        n_folds = 0
+        for bn, bpf, data, file_digest, error in \
+                ingest.parse_jobs(jobs, workers):
+            n_folds += 1
+            if error is not None:
+                # Only happens when reading from a directory.
+                if error == errno.ENOENT:
+                    msg = 'File does not exist: %s' % os.path.join(
+                        in_path, bn + ingest.BESTPROF_SUFFIX)
                     failures.append(msg)
-                except Exception, e:
-                    print e
-                    msg = 'Unknown exception, skipping: %s' % bestprof_file
-                    failures.append(msg)
-                else:
-                    try:
-                        new_image = FoldedImage.objects.create_image(
-                            png_file, beam_name, new
-                        )
-                    except IOError, e:
-                        if e.errno == errno.ENOENT:
-                            msg = 'File does not exist: %s' % png_file
-                            failures.append(msg)
-                    except:
-                        # Database in messy state, should read up on database
-                        # transactions and/or provide a clean-up command.
-                        # (Because .bestprof was loaded but not the .png)
-                        raise
-                    else:
-                        new_image.save()
+                continue
+
+            bestprof_file = bpf.filename
+            png_file = os.path.join(os.path.dirname(bestprof_file),
+                                    bn + ingest.PNG_SUFFIX)
+            writer.add(bestprof_file, png_file, bpf, data, file_digest,
+                       png_data.pop(bn, None))
+        writer.flush()
+        failures.extend(writer.failures)
+        self.stdout.write('Loaded %d folds.' % writer.n_written)
+
+        if from_archive and not n_folds and not completed:
+            raise CommandError('No folds found in: %s' % in_path)
 
         if failures:
             msg = 'Problems with: \n%s' % ('\n'.join(failures))
             raise CommandError(msg)
+
+    def get_journal(self, beam_name, path=None):
+        if path is None:
+            journal_dir = settings.INGEST_JOURNAL_DIR
+            if not os.path.exists(journal_dir):
+                os.makedirs(journal_dir)
+            path = os.path.join(journal_dir, beam_name + '.journal')
+        return ingest.Journal(path)
+
+    def cleanup(self, beam_name):
+        '''
+        Remove the Bestprof rows (and stored files) for beam_name that have
+        no FoldedImage, returns the basenames of the folds removed.
+        '''
+        orphans = Bestprof.objects.filter(beam=beam_name,
+                                          foldedimage__isnull=True)
+        removed = []
+        for bp in orphans:
+            removed.append(ingest.stored_basename(bp.file.name))
+            bp.file.delete(save=False)
+            bp.delete()
+        self.stdout.write('Removed %d folds without image.' % len(removed))
+        return removed
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fold import synthetic
+
+
+class Command(BaseCommand):
+    args = '<output directory> <number of folds>'
+    help = 'Write synthetic .pfd.bestprof and .png pairs (for benchmarks).'
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed (same seed, same folds).'),
+        make_option('--bins', type='int', dest='bins', default=64,
+                    help='Number of profile bins.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args or len(args) != 2:
+            raise CommandError('Specify output directory and number of folds.')
+        try:
+            n_folds = int(args[1])
+        except ValueError:
+            raise CommandError('Number of folds must be an integer.')
+
+        synthetic.write_folds(args[0], n_folds, kwargs.get('seed', 0),
+                              kwargs.get('bins', 64))
+        self.stdout.write('Wrote %d folds to %s' % (n_folds, args[0]))
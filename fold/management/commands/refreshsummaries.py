@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from fold.models import Bestprof, BeamSummary
+
+
+class Command(BaseCommand):
+    args = '[<beam name> ...]'
+    help = 'Recompute the beam summaries of the given beams (default: all).'
+
+    def handle(self, *args, **kwargs):
+        if args:
+            beams = args
+        else:
+            beams = sorted(set(Bestprof.objects.values_list('beam',
+                                                            flat=True)))
+            BeamSummary.objects.exclude(beam__in=beams).delete()
+        for beam in beams:
+            BeamSummary.objects.refresh(beam)
+        self.stdout.write('Refreshed %d beam summaries.' % len(beams))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from fold.models import CandidateTag
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the candidate tag index from the taggit tags (needed ' + \
+        'once for databases that were tagged before the index existed).'
+
+    def handle(self, *args, **kwargs):
+        n_tags = CandidateTag.objects.rebuild()
+        self.stdout.write('Indexed %d candidate tags.' % n_tags)
@@ -0,0 +1,190 @@
+import math
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from fold import coords
+from fold import ingest
+from fold.models import Bestprof, FoldedImage
+
+MANIFEST_NAME = '.pulsarviewer-manifest.json'
+
+
+class Command(BaseCommand):
+    args = '<pulpsearch style output search output directory> <beam name> <ra> <dec>'
+    help = 'Keep loading new or changed pulsar folds from a search ' + \
+        'output directory while it is being written.'
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', dest='interval', default=2,
+                    help='Seconds between directory scans.'),
+        make_option('--settle', type='float', dest='settle', default=2,
+                    help='Only load folds whose files were not modified ' +
+                         'for this many seconds.'),
+        make_option('--rescan-every', type='int', dest='rescan_every',
+                    default=60,
+                    help='Check all known folds for changes every this ' +
+                         'many scans (other scans only look at new files).'),
+        make_option('--manifest', dest='manifest', default=None,
+                    help='Manifest file (defaults to %s in the search ' %
+                         MANIFEST_NAME + 'output directory).'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=200,
+                    help='Number of folds written per database transaction.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Scan the directory once and exit.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not args or len(args) != 4:
+            msg = 'Specify search output dir, beam (no spaces), RA and DEC.'
+            raise CommandError(msg)
+
+        in_dir = os.path.realpath(args[0])
+        if not os.path.isdir(in_dir):
+            raise CommandError('Not a directory: %s' % in_dir)
+        beam_name = args[1]
+        ra = coords.RightAscension.from_sexagesimal(args[2])
+        dec = coords.Declination.from_sexagesimal(args[3])
+        ra_deg = 180 * ra.to_radians() / math.pi
+        dec_deg = 180 * dec.to_radians() / math.pi
+        self.coordinates = (ra_deg, dec_deg, ra, dec)
+
+        self.in_dir = in_dir
+        self.beam_name = beam_name
+        self.settle = kwargs.get('settle', 2)
+        self.batch_size = kwargs.get('batch_size', 200)
+        manifest_path = kwargs.get('manifest') or \
+            os.path.join(in_dir, MANIFEST_NAME)
+        self.manifest = ingest.Manifest(manifest_path)
+
+        interval = kwargs.get('interval', 2)
+        rescan_every = max(kwargs.get('rescan_every', 60), 1)
+        dir_mtime = None
+        basenames = []
+        n_scans = 0
+        while True:
+            # Only list the directory when files were added or removed, and
+            # only look at known folds (for changes) every rescan_every scans.
+            full_scan = n_scans % rescan_every == 0
+            current_mtime = os.stat(in_dir).st_mtime
+            if current_mtime != dir_mtime:
+                dir_mtime = current_mtime
+                basenames = ingest.find_folds(in_dir)
+            if full_scan:
+                todo = basenames
+            else:
+                todo = [bn for bn in basenames if bn not in self.manifest]
+            if todo:
+                self.scan(todo)
+            n_scans += 1
+
+            if kwargs.get('once'):
+                break
+            time.sleep(interval)
+
+    def scan(self, basenames):
+        '''
+        Load the folds for basenames that are new or changed and settled.
+        '''
+        now = time.time()
+        ready = []
+        for bn in basenames:
+            bestprof_file = os.path.join(self.in_dir,
+                                         bn + ingest.BESTPROF_SUFFIX)
+            png_file = os.path.join(self.in_dir, bn + ingest.PNG_SUFFIX)
+            bestprof_stat = ingest.stat_file(bestprof_file)
+            png_stat = ingest.stat_file(png_file)
+            if bestprof_stat is None or png_stat is None:
+                continue
+            if self.manifest.is_current(bn, bestprof_stat, png_stat):
+                continue
+            if now - max(bestprof_stat[1], png_stat[1]) < self.settle:
+                # Still being written, try again on the next scan.
+                continue
+            ready.append((bn, bestprof_file, png_file, bestprof_stat,
+                          png_stat))
+
+        if not ready:
+            return
+
+        # The manifest only gets the folds that were committed (or were in
+        # the database already), all others are tried again on a later scan.
+        queued = {}
+
+        def on_commit(bestprof_files):
+            for bestprof_file in bestprof_files:
+                self.manifest.update(*queued.pop(bestprof_file))
+
+        writer = ingest.BatchWriter(self.beam_name, *self.coordinates,
+                                    batch_size=self.batch_size,
+                                    on_commit=on_commit)
+        try:
+            for bn, bestprof_file, png_file, bestprof_stat, png_stat in ready:
+                try:
+                    _, bpf, data, file_digest, error = ingest.parse_fold(
+                        (bn, bestprof_file, None))
+                except Exception, e:
+                    # Do not retry broken files until they change again.
+                    self.stderr.write('Cannot parse %s: %s' %
+                                      (bestprof_file, e))
+                    self.manifest.update(bn, bestprof_stat, png_stat, None)
+                    continue
+                if error is not None:
+                    continue
+
+                old_digest = None
+                if bn in self.manifest:
+                    old_digest = self.manifest.digest(bn)
+                    if old_digest == file_digest:
+                        # Only touched, or a new .png for the same fold.
+                        if self.manifest.png_changed(bn, png_stat) and \
+                                not self.reload_image(png_file, file_digest):
+                            continue
+                        self.manifest.update(bn, bestprof_stat, png_stat,
+                                             file_digest)
+                        continue
+                    if old_digest is not None:
+                        # Fold was changed after it was loaded, replace it.
+                        self.stderr.write('Replacing changed fold (tags are '
+                                          'lost): %s' % bestprof_file)
+                queued[bestprof_file] = (bn, bestprof_stat, png_stat,
+                                         file_digest)
+                writer.add(bestprof_file, png_file, bpf, data, file_digest,
+                           replaces=old_digest)
+            writer.flush()
+        finally:
+            self.manifest.save()
+
+        for msg in writer.failures:
+            self.stderr.write(msg)
+        if writer.n_written:
+            self.stdout.write('Loaded %d folds.' % writer.n_written)
+
+    def reload_image(self, png_file, file_digest):
+        '''
+        Replace the FoldedImage of the fold with file_digest by png_file,
+        returns whether that worked (else it is tried again on a later scan).
+        '''
+        try:
+            bp = Bestprof.objects.get(file_digest=file_digest)
+            new_image = FoldedImage.objects.create_image(
+                png_file, self.beam_name, bp)
+        except Bestprof.DoesNotExist:
+            # Removed from the database, there is no image to replace.
+            return True
+        except IOError, e:
+            self.stderr.write('Cannot read %s: %s' % (png_file, e))
+            return False
+        old_images = list(bp.foldedimage_set.all())
+        with transaction.commit_on_success():
+            FoldedImage.objects.filter(
+                pk__in=[image.pk for image in old_images]).delete()
+            new_image.save()
+        for image in old_images:
+            image.file.delete(save=False)
+        self.stdout.write('Reloaded image: %s' % png_file)
+        return True
@@ -1,25 +1,74 @@
+import base64
+import hashlib
+import itertools
 import os
 
-from django.db import models
-from django.core.files import File
+import numpy
+
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.utils import simplejson
 
 from taggit.managers import TaggableManager
+from taggit.models import Tag, TaggedItem
 
 import bestprof
 
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def read_file(filename):
+    '''
+    Read a file in one pass, returns its contents and their SHA-256 digest.
+    '''
+    digest = hashlib.sha256()
+    chunks = []
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), ''):
+            digest.update(chunk)
+            chunks.append(chunk)
+    return ''.join(chunks), digest.hexdigest()
+
+
+def pack_profile(profile):
+    '''
+    Pack a pulse profile as base64 encoded little-endian float32 values.
+    '''
+    return base64.b64encode(numpy.asarray(profile, dtype='<f4').tostring())
+
+
+def unpack_profile(packed):
+    '''
+    Unpack a pulse profile packed by pack_profile, returns an ndarray.
+    '''
+    return numpy.frombuffer(base64.b64decode(packed), dtype='<f4')
+
 
 class BestprofManager(models.Manager):
-    def create_bestprof(self, filename, beamname, ra_deg, dec_deg, ra, dec):
-        bpf = bestprof.BestprofFile(filename)
-        with open(filename) as f:
-            file_hash = hash(f.read())
+    def create_bestprof(self, filename, beamname, ra_deg, dec_deg, ra, dec,
+                        bpf=None, data=None, file_digest=None):
+        # The file is read only once, its contents are used for parsing,
+        # hashing and the stored copy. The file can also be read, parsed and
+        # hashed beforehand (e.g. in a worker process), pass data, bpf and
+        # file_digest to skip doing that again here.
+        if data is None:
+            data, file_digest = read_file(filename)
+        elif file_digest is None:
+            file_digest = hashlib.sha256(data).hexdigest()
+        if bpf is None:
+            bpf = bestprof.BestprofFile(filename, data=data)
 
         new = Bestprof(
-            file_hash=file_hash,
+            file_hash=hash(data),
+            file_digest=file_digest,
             beam=beamname,
-            file=File(open(filename)),
+            file=ContentFile(data, name=os.path.basename(filename)),
+            profile_data=pack_profile(bpf.profile),
             ra=ra,
             dec=dec,
             ra_deg=ra_deg,
@@ -99,7 +148,8 @@ class BestprofManager(models.Manager):
 
         if 'tag' in get_pars:
             tag = get_pars['tag']  # possibly do some filtering here
-            qs = qs.filter(tags__name__in=[tag])
+            # Through the CandidateTag index, not taggit's generic relation.
+            qs = qs.filter(candidate_tags__name=tag)
 
         try:
             beam = get_pars['beam']
@@ -117,6 +167,61 @@ class BestprofManager(models.Manager):
 
         return qs
 
+    def bulk_tag(self, name, qs=None, pks=None, remove=False,
+                 batch_size=500):
+        '''
+        Add (or remove) the tag name to (from) all candidates in qs or with
+        the primary keys pks, in batches within a single transaction.
+
+        The batches stay below SQLite's limit of 999 query parameters.
+
+        Returns the number of candidates that were changed.
+        '''
+        if pks is None:
+            rows = qs.order_by().values_list('pk', 'beam').iterator()
+        else:
+            rows = self.filter(pk__in=pks).values_list('pk', 'beam').iterator()
+        if remove:
+            try:
+                tag = Tag.objects.get(name=name)
+            except Tag.DoesNotExist:
+                return 0
+        content_type = ContentType.objects.get_for_model(Bestprof)
+
+        n_changed = 0
+        beams = set()
+        with transaction.commit_on_success():
+            if not remove:
+                tag, _ = Tag.objects.get_or_create(name=name)
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                batch_pks = [pk for pk, _ in batch]
+                tagged = TaggedItem.objects.filter(
+                    tag=tag, content_type=content_type,
+                    object_id__in=batch_pks)
+                if remove:
+                    # The delete signals also remove the CandidateTag rows.
+                    n_changed += tagged.count()
+                    tagged.delete()
+                else:
+                    done = set(tagged.values_list('object_id', flat=True))
+                    TaggedItem.objects.bulk_create([
+                        TaggedItem(tag=tag, content_type=content_type,
+                                   object_id=pk)
+                        for pk in batch_pks if pk not in done])
+                    CandidateTag.objects.bulk_create([
+                        CandidateTag(bestprof_id=pk, name=tag.name)
+                        for pk in batch_pks if pk not in done])
+                    n_changed += len(batch_pks) - len(done)
+                beams.update(beam for _, beam in batch)
+            for beam in beams:
+                BeamSummary.objects.refresh_tags(beam)
+        if n_changed:
+            DataGeneration.objects.bump()
+        return n_changed
+
 
 def generate_bestprof_filename(instance, filename):
     return 'fold/%s/%s' % (instance.beam, os.path.basename(filename))
@@ -126,8 +231,12 @@ class Bestprof(models.Model):
     '''
     Header of bestprof file.
     '''
-    file_hash = models.IntegerField(unique=True, editable=False)
-    beam = models.CharField(max_length=255)
+    # file_hash holds Python's hash() of the file and is only kept for
+    # existing databases, duplicates are detected through file_digest.
+    file_hash = models.IntegerField(editable=False)
+    file_digest = models.CharField(max_length=64, unique=True, null=True,
+                                   editable=False)
+    beam = models.CharField(max_length=255, db_index=True)
     file = models.FileField(upload_to=generate_bestprof_filename,
                             editable=False)
     ra = models.CharField(max_length=25)
@@ -148,21 +257,60 @@ class Bestprof(models.Model):
     profile_bins = models.IntegerField()
     profile_avg = models.FloatField()
     profile_stddev = models.FloatField()
-    reduced_chi_sq = models.FloatField()
-    best_dm = models.FloatField()
+    reduced_chi_sq = models.FloatField(db_index=True)
+    best_dm = models.FloatField(db_index=True)
     p_topo = models.FloatField()
     p_dot_topo = models.FloatField()
     p_dot_dot_topo = models.FloatField()
-    p_bary = models.FloatField()
+    p_bary = models.FloatField(db_index=True)
     p_dot_bary = models.FloatField()
     p_dot_dot_bary = models.FloatField()
+    # Pulse profile, see pack_profile. Empty for folds loaded before the
+    # profiles were stored.
+    profile_data = models.TextField(blank=True, default='', editable=False)
 
     objects = BestprofManager()
     tags = TaggableManager()
 
+    class Meta:
+        # For the filters and orderings in BestprofManager.with_constraints,
+        # syncdb does not add them to an existing database: ./manage.py
+        # sqlindexes fold only prints the CREATE INDEX statements, run the
+        # new ones through ./manage.py dbshell.
+        index_together = [
+            ['beam', 'reduced_chi_sq'],
+            ['best_dm', 'p_bary'],
+            ['p_bary', 'best_dm'],
+            # keyset pagination, see pagination.py
+            ['reduced_chi_sq', 'id'],
+        ]
+
     def __unicode__(self):
         return 'DM = %.3f P = %.4f (ms)' % (self.best_dm, self.p_bary)
 
+    @property
+    def profile(self):
+        '''
+        Pulse profile as a float32 ndarray, unpacked on first access.
+        '''
+        try:
+            return self._profile
+        except AttributeError:
+            pass
+        if self.profile_data:
+            self._profile = unpack_profile(self.profile_data)
+        else:
+            # Older folds, fall back to parsing the stored .bestprof file.
+            self.file.open('rb')
+            try:
+                bpf = bestprof.BestprofFile(self.file.name, vectorized=True,
+                                            dtype=numpy.float32,
+                                            data=self.file.read())
+            finally:
+                self.file.close()
+            self._profile = bpf.profile
+        return self._profile
+
     def get_absolute_url(self):
         return reverse('bestprof_detail', args=(self.pk,))
 
@@ -172,11 +320,17 @@ def generate_png_filename(instance, filename):
 
 
 class FoldedImageManager(models.Manager):
-    def create_image(self, filename, beamname, bestprof_instance):
+    def create_image(self, filename, beamname, bestprof_instance, data=None):
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
         new_image = FoldedImage(
             beam=beamname,
-            file=File(open(filename)),
-            bestprof=bestprof_instance)
+            file=ContentFile(data, name=os.path.basename(filename)))
+        # Batched writers only know the Bestprof primary key after the bulk
+        # insert, they pass None here and set bestprof_id later.
+        if bestprof_instance is not None:
+            new_image.bestprof = bestprof_instance
         return new_image
 
 
@@ -188,3 +342,254 @@ class FoldedImage(models.Model):
     bestprof = models.ForeignKey(Bestprof)
 
     objects = FoldedImageManager()
+
+
+class Tile(models.Model):
+    '''
+    Precomputed tile of the P-DM map for one beam, see tiles.py. The cells
+    are stored as JSON: a list of [cell x, cell y, count, max. reduced
+    chi-square] for the non empty cells.
+    '''
+    beam = models.CharField(max_length=255, db_index=True)
+    zoom = models.IntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    n_candidates = models.IntegerField()
+    cells = models.TextField()
+
+    class Meta:
+        unique_together = [['beam', 'zoom', 'x', 'y']]
+        index_together = [['zoom', 'x', 'y']]
+
+
+class CandidateTagManager(models.Manager):
+    def tag_names(self, pks):
+        '''
+        Return a dictionary mapping the primary keys of candidates to the
+        (sorted) names of their tags, in one query.
+        '''
+        tags = dict((pk, []) for pk in pks)
+        for pk, name in self.filter(bestprof__in=pks).order_by(
+                'name').values_list('bestprof', 'name'):
+            tags[pk].append(name)
+        return tags
+
+    def rebuild(self):
+        '''
+        Rebuild the index from taggit's tagged items, returns its size.
+        '''
+        content_type = ContentType.objects.get_for_model(Bestprof)
+        items = TaggedItem.objects.filter(
+            content_type=content_type,
+            object_id__in=Bestprof.objects.values('pk')).values_list(
+                'object_id', 'tag__name').distinct()
+        with transaction.commit_on_success():
+            self.all().delete()
+            self.bulk_create([CandidateTag(bestprof_id=pk, name=name)
+                              for pk, name in items])
+        return self.count()
+
+
+class CandidateTag(models.Model):
+    '''
+    Index of the tags of the candidates, a copy of taggit's tagged items
+    that can be joined directly (instead of through content type and object
+    id). Kept in sync by signals and by BestprofManager.bulk_tag.
+    '''
+    bestprof = models.ForeignKey(Bestprof, related_name='candidate_tags')
+    name = models.CharField(max_length=100)
+
+    objects = CandidateTagManager()
+
+    class Meta:
+        unique_together = [['bestprof', 'name']]
+        index_together = [['name', 'bestprof']]
+
+    def __unicode__(self):
+        return self.name
+
+
+# Columns of Bestprof for which BeamSummary keeps the range.
+SUMMARY_RANGES = ('p_bary', 'best_dm', 'reduced_chi_sq')
+
+
+class BeamSummaryManager(models.Manager):
+    def add_candidates(self, beam, bestprofs):
+        '''
+        Update the summary of beam with newly loaded Bestprof instances.
+        '''
+        if not bestprofs:
+            return
+        summary, _ = self.get_or_create(beam=beam)
+        summary.n_candidates += len(bestprofs)
+        for field in SUMMARY_RANGES:
+            values = [getattr(bp, field) for bp in bestprofs]
+            lo, hi = getattr(summary, 'min_' + field), \
+                getattr(summary, 'max_' + field)
+            setattr(summary, 'min_' + field,
+                    min(values) if lo is None else min(lo, min(values)))
+            setattr(summary, 'max_' + field,
+                    max(values) if hi is None else max(hi, max(values)))
+        summary.save()
+
+    def refresh(self, beam):
+        '''
+        Recompute the summary of beam from its candidates.
+        '''
+        aggregates = [models.Count('pk')]
+        for field in SUMMARY_RANGES:
+            aggregates.extend([models.Min(field), models.Max(field)])
+        result = Bestprof.objects.filter(beam=beam).aggregate(*aggregates)
+        if not result['pk__count']:
+            self.filter(beam=beam).delete()
+            return
+        summary, _ = self.get_or_create(beam=beam)
+        summary.n_candidates = result['pk__count']
+        for field in SUMMARY_RANGES:
+            setattr(summary, 'min_' + field, result[field + '__min'])
+            setattr(summary, 'max_' + field, result[field + '__max'])
+        summary.tag_data = simplejson.dumps(self._tag_counts(beam))
+        summary.save()
+
+    def refresh_tags(self, beam):
+        self.filter(beam=beam).update(
+            tag_data=simplejson.dumps(self._tag_counts(beam)))
+
+    def _tag_counts(self, beam):
+        qs = CandidateTag.objects.filter(bestprof__beam=beam)
+        return dict(qs.values_list('name').annotate(models.Count('pk')))
+
+    def totals(self):
+        '''
+        Return a BeamSummary (not saved) for all beams together.
+        '''
+        aggregates = [models.Sum('n_candidates')]
+        for field in SUMMARY_RANGES:
+            aggregates.extend([models.Min('min_' + field),
+                               models.Max('max_' + field)])
+        result = self.aggregate(*aggregates)
+        total = BeamSummary(beam='', n_candidates=
+                            result['n_candidates__sum'] or 0)
+        for field in SUMMARY_RANGES:
+            setattr(total, 'min_' + field, result['min_%s__min' % field])
+            setattr(total, 'max_' + field, result['max_%s__max' % field])
+        tag_counts = {}
+        for tag_data in self.values_list('tag_data', flat=True):
+            for name, count in simplejson.loads(tag_data).iteritems():
+                tag_counts[name] = tag_counts.get(name, 0) + count
+        total.tag_data = simplejson.dumps(tag_counts)
+        return total
+
+
+class BeamSummary(models.Model):
+    '''
+    Number of candidates, ranges of P, DM and reduced chi-square and tag
+    counts of one beam, kept up to date at ingest and when tagging.
+    '''
+    beam = models.CharField(max_length=255, unique=True)
+    n_candidates = models.IntegerField(default=0)
+    min_p_bary = models.FloatField(null=True)
+    max_p_bary = models.FloatField(null=True)
+    min_best_dm = models.FloatField(null=True)
+    max_best_dm = models.FloatField(null=True)
+    min_reduced_chi_sq = models.FloatField(null=True)
+    max_reduced_chi_sq = models.FloatField(null=True)
+    # JSON object mapping tag name to the number of candidates with it.
+    tag_data = models.TextField(default='{}')
+
+    objects = BeamSummaryManager()
+
+    class Meta:
+        ordering = ['beam']
+
+    def __unicode__(self):
+        return self.beam
+
+    @property
+    def tag_counts(self):
+        return sorted(simplejson.loads(self.tag_data).items())
+
+    def range(self, field):
+        return getattr(self, 'min_' + field), getattr(self, 'max_' + field)
+
+
+class DataGenerationManager(models.Manager):
+    def current(self):
+        '''
+        Return the current data generation.
+        '''
+        tmp = list(self.filter(pk=1).values_list('counter', flat=True))
+        return tmp[0] if tmp else 0
+
+    def bump(self):
+        '''
+        Increment the data generation, invalidates all cached results.
+        '''
+        if not self.filter(pk=1).update(counter=F('counter') + 1):
+            self.get_or_create(pk=1, defaults={'counter': 1})
+
+
+class DataGeneration(models.Model):
+    '''
+    Counter that is incremented whenever candidates or their tags change,
+    cached results (see caching.py) are keyed on it.
+    '''
+    counter = models.PositiveIntegerField(default=0)
+
+    objects = DataGenerationManager()
+
+
+def bump_data_generation(sender, **kwargs):
+    DataGeneration.objects.bump()
+
+
+def update_beam_summary(sender, instance, created, **kwargs):
+    if created:
+        BeamSummary.objects.add_candidates(instance.beam, [instance])
+    else:
+        BeamSummary.objects.refresh(instance.beam)
+
+
+def refresh_beam_summary(sender, instance, **kwargs):
+    BeamSummary.objects.refresh(instance.beam)
+
+
+def _tags_bestprof(instance):
+    content_type = ContentType.objects.get_for_id(instance.content_type_id)
+    return content_type.model_class() is Bestprof
+
+
+def add_candidate_tag(sender, instance, created, **kwargs):
+    if created and _tags_bestprof(instance) and \
+            Bestprof.objects.filter(pk=instance.object_id).exists():
+        CandidateTag.objects.get_or_create(bestprof_id=instance.object_id,
+                                           name=instance.tag.name)
+
+
+def remove_candidate_tag(sender, instance, **kwargs):
+    if _tags_bestprof(instance):
+        CandidateTag.objects.filter(bestprof=instance.object_id,
+                                    name=instance.tag.name).delete()
+
+
+def refresh_beam_tags(sender, instance, **kwargs):
+    if not _tags_bestprof(instance):
+        return
+    beams = Bestprof.objects.filter(pk=instance.object_id).values_list(
+        'beam', flat=True)
+    for beam in beams:
+        BeamSummary.objects.refresh_tags(beam)
+
+# Bulk writes (that do not send signals) call DataGeneration.objects.bump()
+# themselves.
+post_save.connect(bump_data_generation, sender=TaggedItem)
+post_delete.connect(bump_data_generation, sender=TaggedItem)
+post_save.connect(bump_data_generation, sender=Bestprof)
+post_delete.connect(bump_data_generation, sender=Bestprof)
+# Before the beam summaries, these count the candidate tags.
+post_save.connect(add_candidate_tag, sender=TaggedItem)
+post_delete.connect(remove_candidate_tag, sender=TaggedItem)
+post_save.connect(refresh_beam_tags, sender=TaggedItem)
+post_delete.connect(refresh_beam_tags, sender=TaggedItem)
+post_save.connect(update_beam_summary, sender=Bestprof)
+post_delete.connect(refresh_beam_summary, sender=Bestprof)
@@ -0,0 +1,152 @@
+'''
+Keyset (seek) pagination for candidate selections.
+
+Instead of an OFFSET and a COUNT(*) every page is selected with a WHERE
+clause on the ordering columns of the last (or first) row of the previous
+page, so that deep pages cost as much as the first one. The position is
+passed around as an opaque cursor.
+'''
+import base64
+import json
+
+from django.db.models import Q
+
+# Ordering columns (and whether they are sorted descending) for the values
+# of the order GET parameter, the primary key breaks ties.
+ORDERINGS = {
+    'pk': (('pk', False),),
+    'redchisq': (('reduced_chi_sq', True), ('pk', False)),
+}
+DEFAULT_ORDERING = 'pk'
+
+FORWARD = 'n'
+BACKWARD = 'p'
+
+
+def encode_cursor(direction, values):
+    return base64.urlsafe_b64encode(json.dumps([direction] + list(values)))
+
+
+def decode_cursor(cursor):
+    '''
+    Return (direction, values) for a cursor, raises ValueError for cursors
+    that were not made by encode_cursor.
+    '''
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(decoded, list) or not decoded:
+        raise ValueError('Invalid cursor.')
+    direction, values = decoded[0], decoded[1:]
+    if direction not in (FORWARD, BACKWARD):
+        raise ValueError('Invalid cursor.')
+    # Only values as made by encode_cursor can go into a filter.
+    for value in values:
+        if value is not None and \
+                not isinstance(value, (int, long, float, basestring)):
+            raise ValueError('Invalid cursor.')
+    return direction, values
+
+
+def seek_filter(ordering, values, backward=False):
+    '''
+    Return a Q object selecting the rows after (or before) the row with the
+    given values for the ordering columns.
+    '''
+    q = None
+    for i, (field, descending) in enumerate(ordering):
+        after = descending == backward
+        lookup = '%s__%s' % (field, 'gt' if after else 'lt')
+        term = Q(**{lookup: values[i]})
+        for j, (prev_field, _) in enumerate(ordering[:i]):
+            term &= Q(**{prev_field: values[j]})
+        q = term if q is None else q | term
+    return q
+
+
+class KeysetPage(object):
+    '''
+    One page of a keyset paginated selection, quacks a bit like Django's
+    Page (object_list, has_next and has_previous).
+
+    queryset selects the rows on the page (in reverse order for pages that
+    were reached backwards), object_list holds them in the right order. Only
+    the ordering columns are fetched to find the cursors.
+    '''
+    def __init__(self, qs, ordering, per_page, backward, has_cursor):
+        self.queryset = qs[:per_page]
+        self.ordering = ordering
+        self.backward = backward
+
+        fields = [field for field, _ in ordering]
+        keys = list(qs.values_list(*fields)[:per_page + 1])
+        has_more = len(keys) > per_page
+        keys = keys[:per_page]
+        if backward:
+            keys.reverse()
+            self._has_next, self._has_previous = True, has_more
+        else:
+            self._has_next, self._has_previous = has_more, has_cursor
+        self._first_key = keys[0] if keys else None
+        self._last_key = keys[-1] if keys else None
+
+    @property
+    def object_list(self):
+        try:
+            return self._object_list
+        except AttributeError:
+            pass
+        self._object_list = list(self.queryset)
+        if self.backward:
+            self._object_list.reverse()
+        return self._object_list
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next and self._last_key is not None
+
+    def has_previous(self):
+        return self._has_previous and self._first_key is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return encode_cursor(FORWARD, self._last_key)
+        return ''
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return encode_cursor(BACKWARD, self._first_key)
+        return ''
+
+
+def keyset_page(qs, order, cursor, per_page):
+    '''
+    Return the KeysetPage of qs that cursor points at (the first page for
+    an empty cursor), order is the value of the order GET parameter.
+    '''
+    ordering = ORDERINGS.get(order, ORDERINGS[DEFAULT_ORDERING])
+    if cursor:
+        direction, values = decode_cursor(cursor)
+        if len(values) != len(ordering):
+            raise ValueError('Cursor does not match ordering.')
+    else:
+        direction, values = FORWARD, None
+    backward = direction == BACKWARD
+
+    order_by = [('-' if descending != backward else '') + field
+                for field, descending in ordering]
+    qs = qs.order_by(*order_by)
+    if values is not None:
+        qs = qs.filter(seek_filter(ordering, values, backward))
+    return KeysetPage(qs, ordering, per_page, backward, values is not None)
@@ -0,0 +1,82 @@
+'''
+In memory cache for the rendered SVG plots.
+
+Rendering the plots with brp.svg is slow, so the result is kept per plot
+type, set of constraints, page and data generation (loading folds or
+tagging candidates starts a new generation, so old entries are simply
+never asked for again and are evicted). The cache is bounded by the total
+size of the stored plots and evicts the least recently used plots first.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from caching import constraint_signature
+from models import DataGeneration
+
+
+class PlotCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._plots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._plots)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                plot = self._plots.pop(key)
+            except KeyError:
+                return None
+            self._plots[key] = plot
+            return plot
+
+    def set(self, key, plot):
+        if len(plot) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._plots:
+                self.n_bytes -= len(self._plots.pop(key))
+            self._plots[key] = plot
+            self.n_bytes += len(plot)
+            while self.n_bytes > self.max_bytes:
+                _, old = self._plots.popitem(last=False)
+                self.n_bytes -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._plots.clear()
+            self.n_bytes = 0
+
+
+PLOT_CACHE = PlotCache(getattr(settings, 'PLOT_CACHE_BYTES', 64 * 1024 ** 2))
+
+
+def plot_key(kind, get_pars, generation=None):
+    '''
+    Return the cache key for a plot of type kind, get_pars should contain
+    the (checked) constraints and the page number or cursor.
+    '''
+    if generation is None:
+        generation = DataGeneration.objects.current()
+    signature = constraint_signature(get_pars, ignore=())
+    return hashlib.md5('%s:%d:%s' % (kind, generation, signature)).hexdigest()
+
+
+def cached_plot(key, render):
+    '''
+    Return the plot stored under key, calls render() to make it on a miss.
+    An empty key disables caching.
+    '''
+    if not key:
+        return render()
+    plot = PLOT_CACHE.get(key)
+    if plot is None:
+        plot = render()
+        PLOT_CACHE.set(key, plot)
+    return plot
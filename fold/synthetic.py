@@ -0,0 +1,137 @@
+'''
+Generate synthetic PRESTO folds (.pfd.bestprof and .png pairs) for testing
+and benchmarking the ingest code.
+'''
+import math
+import os
+import random
+import struct
+import zlib
+
+BESTPROF_HEADER = '''\
+# Input file       =  %(input_file)s
+# Candidate        =  %(candidate)s
+# Telescope        =  LOFAR
+# Epoch_topo       =  %(epoch_topo).9f
+# Epoch_bary (MJD) =  %(epoch_bary).9f
+# T_sample         =  0.00065536
+# Data Folded      =  %(data_folded)d
+# Data Avg         =  %(data_avg).6g
+# Data StdDev      =  %(data_stddev).6g
+# Profile Bins     =  %(profile_bins)d
+# Profile Avg      =  %(profile_avg).6g
+# Profile StdDev   =  %(profile_stddev).6g
+# Reduced chi-sqr  =  %(reduced_chi_sq).3f
+# Prob(Noise)      <  %(prob_noise).3g   (~%(sigma).1f sigma)
+# Best DM          =  %(best_dm).3f
+# P_topo (ms)      =  %(p_topo).10g +/- %(p_err).3g
+# P'_topo (s/s)    =  %(p_dot).6g +/- %(p_dot_err).3g
+# P''_topo (s/s^2) =  0 +/- 1.5e-15
+# P_bary (ms)      =  %(p_bary).10g +/- %(p_err).3g
+# P'_bary (s/s)    =  %(p_dot).6g +/- %(p_dot_err).3g
+# P''_bary (s/s^2) =  0 +/- 1.5e-15
+# P_orb (s)        =  N/A
+# asin(i)/c (s)    =  N/A
+# eccentricity     =  N/A
+# w (rad)          =  N/A
+# T_peri           =  N/A
+######################################################
+'''
+
+
+def make_bestprof(rng, name, n_bins=64):
+    '''
+    Return the contents of a synthetic .pfd.bestprof file.
+
+    Periods are drawn log-uniformly between 1 ms and 5 s, DMs uniformly
+    between 0 and 500 and reduced chi-squared values from a log-normal
+    distribution, the profile is noise with a gaussian pulse on top.
+    '''
+    p_bary = 10 ** rng.uniform(0, 3.7)
+    best_dm = rng.uniform(0, 500)
+    reduced_chi_sq = rng.lognormvariate(0.5, 0.6)
+    profile_avg = rng.uniform(900, 1100)
+    profile_stddev = rng.uniform(10, 40)
+    amplitude = profile_stddev * max(reduced_chi_sq - 1, 0) * 2
+    phase = rng.random()
+    width = rng.uniform(0.01, 0.1)
+    profile = []
+    for i in range(n_bins):
+        d = abs(float(i) / n_bins - phase)
+        d = min(d, 1 - d)
+        profile.append(profile_avg + rng.gauss(0, profile_stddev) +
+                       amplitude * math.exp(-0.5 * (d / width) ** 2))
+
+    values = {
+        'input_file': name + '.dat',
+        'candidate': 'ACCEL_Cand_%d' % rng.randint(1, 200),
+        'epoch_topo': 56000 + rng.random(),
+        'epoch_bary': 56000 + rng.random(),
+        'data_folded': 2 ** 20,
+        'data_avg': rng.uniform(90, 110),
+        'data_stddev': rng.uniform(5, 15),
+        'profile_bins': n_bins,
+        'profile_avg': profile_avg,
+        'profile_stddev': profile_stddev,
+        'reduced_chi_sq': reduced_chi_sq,
+        'prob_noise': 10 ** -rng.uniform(0, 30),
+        'sigma': rng.uniform(0, 30),
+        'best_dm': best_dm,
+        'p_topo': p_bary * (1 + rng.uniform(-1e-4, 1e-4)),
+        'p_bary': p_bary,
+        'p_err': p_bary * 1e-6,
+        'p_dot': rng.uniform(-1e-10, 1e-10),
+        'p_dot_err': 1e-11,
+    }
+    lines = [BESTPROF_HEADER % values]
+    lines.extend('%4d  %.7g\n' % (i, v) for i, v in enumerate(profile))
+    return ''.join(lines)
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + \
+        struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+
+def make_png(rng, width=640, height=480):
+    '''
+    Return the contents of a (valid) grayscale noise PNG image.
+
+    The noise is quantized to 16 levels and the rows are drawn from a small
+    pool so that the image compresses about as well as the prepfold plots
+    do (and is quick to generate).
+    '''
+    pool = ['\x00' + ''.join(chr(rng.randint(0, 15) * 17)
+                             for _ in range(width))
+            for _ in range(min(height, 32))]
+    rows = [rng.choice(pool) for _ in range(height)]
+    return '\x89PNG\r\n\x1a\n' + \
+        _png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0,
+                                       0, 0)) + \
+        _png_chunk('IDAT', zlib.compress(''.join(rows))) + \
+        _png_chunk('IEND', '')
+
+
+def write_folds(out_dir, n_folds, seed=0, n_bins=64, png_size=(640, 480)):
+    '''
+    Write n_folds synthetic .pfd.bestprof and .png pairs to out_dir.
+
+    Returns the basenames of the folds. The same seed always produces the
+    same files.
+    '''
+    rng = random.Random(seed)
+    # Generating a fresh image for every fold is slow, reuse a small pool.
+    pngs = [make_png(rng, *png_size) for _ in range(min(n_folds, 16))]
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    basenames = []
+    for i in range(n_folds):
+        bn = 'synthetic_%07d' % i
+        with open(os.path.join(out_dir, bn + '.pfd.bestprof'), 'w') as f:
+            f.write(make_bestprof(rng, bn, n_bins))
+        with open(os.path.join(out_dir, bn + '.png'), 'wb') as f:
+            f.write(pngs[i % len(pngs)])
+        basenames.append(bn)
+    return basenames
@@ -2,38 +2,128 @@ from django import template
 from django.core.urlresolvers import reverse
 import StringIO
 import copy
+import math
 
 from brp.svg.base import SVGCanvas, PlotContainer, TextFragment
 from brp.svg.plotters.scatter import ScatterPlotter
 from brp.svg.plotters.gradient import GradientPlotter, RGBGradient
 from brp.svg.plotters.symbol import RADECSymbol
-from brp.svg.plotters.histogram import HistogramPlotter, bin_data_log
+from brp.svg.plotters.histogram import HistogramPlotter
+
+from fold.columns import scatter_columns, detail_links
+from fold.plotcache import cached_plot
+from fold import density
 
 register = template.Library()
 
 
-class CandidateGraphNode(template.Node):
+class CachedPlotNode(template.Node):
+    '''
+    Plot node whose output is cached under the plot_cache_key of the
+    context (see plotcache.py), subclasses implement render_plot.
+    '''
+    def render(self, context):
+        return cached_plot(context.get('plot_cache_key'),
+                           lambda: self.render_plot(context))
+
+
+def gradient_range(context, columns, field):
+    '''
+    Range of field for the color gradient, from the beam summaries (see
+    views.summary_ranges) if available, else from the candidates shown.
+    '''
+    ranges = context.get('gradient_ranges') or {}
+    if field in ranges and None not in ranges[field]:
+        return ranges[field]
+    return float(columns[field].min()), float(columns[field].max())
+
+
+def render_density(qs, context, y_field, y_label, value_field, value_label):
+    '''
+    Render all candidates of qs binned on a log P x log y_field grid, cells
+    are shaded by count or (with shade=max in the context) by the maximum
+    of value_field. Every cell links to the list of its candidates.
+    '''
+    by_max = context.get('shade') == 'max'
+    grid = density.bin_queryset(qs, 'p_bary', y_field,
+                                value_field if by_max else None)
+
+    cv = SVGCanvas(940, 550, background_color='white')
+    if grid is not None:
+        n_candidates = int(grid[2].sum())
+        cells = list(density.iter_cells(*grid))
+        list_url = reverse('bestprof_list')
+        selection = context.get('selection', '')
+        X = [math.sqrt(c[0] * c[1]) for c in cells]
+        Y = [math.sqrt(c[2] * c[3]) for c in cells]
+        SHADE = [c[5] if by_max else c[4] for c in cells]
+        upper_edges = (grid[0][-1], grid[1][-1])
+        LINKS = [density.cell_link(list_url, selection, 'p_bary', y_field, c,
+                                   upper_edges) for c in cells]
+
+        pc = PlotContainer(0, -20, 880, 550, color='black', x_log=True,
+                           y_log=True, data_background_color='gray')
+        pc.bottom.set_label('Period (ms)')
+        pc.top.hide_label()
+        pc.left.set_label(y_label)
+        pc.right.hide_label()
+        gr = RGBGradient((min(SHADE), max(SHADE)), (0, 0, 1), (1, 0, 0))
+        pc.add_plotter(ScatterPlotter(X, Y, SHADE, gradient=gr, gradient_i=2,
+                                      links=LINKS))
+        cv.add_plot_container(pc)
+        # Gradient:
+        pc = PlotContainer(820, -20, 120, 550, color='black', data_padding=0)
+        pc.top.hide_label()
+        pc.top.hide_tickmarks()
+        pc.left.hide_tickmarks()
+        pc.bottom.hide_label()
+        pc.bottom.hide_tickmarks()
+        pc.left.hide_label()
+        pc.right.set_label('Maximum ' + value_label if by_max else
+                           'Candidates per cell')
+        pc.add_plotter(GradientPlotter(gr))
+        cv.add_plot_container(pc)
+        tf = TextFragment(50, 520, '(Showing %d candidates in %d cells.)' %
+                          (n_candidates, len(cells)), color='black',
+                          font_size=15)
+        cv.add_plot_container(tf)
+    else:
+        tf = TextFragment(200, 200, 'No Candidates found.', color='red',
+                          font_size=50)
+        cv.add_plot_container(tf)
+
+    tmp = StringIO.StringIO()
+    cv.draw(tmp)
+    return tmp.getvalue()
+
+
+class CandidateGraphNode(CachedPlotNode):
     def __init__(self, var_name):
         self.var_name = var_name
 
-    def render(self, context):
+    def render_plot(self, context):
 
         qs = context[self.var_name]
+        if context.get('density'):
+            return render_density(qs, context, 'best_dm',
+                                  'Dispersion Measure (cm^-3 pc)',
+                                  'reduced_chi_sq',
+                                  'Candidate Reduced Chi-Square')
         tmp = StringIO.StringIO()
 
         cv = SVGCanvas(940, 550, background_color='white')
 
-        P = [c.p_bary for c in qs.all() if c.best_dm > 0]
-        DM = [c.best_dm for c in qs.all() if c.best_dm > 0]
-        REDCHISQ = [c.reduced_chi_sq for c in qs.all() if c.best_dm > 0]
-        LINKS = [reverse('bestprof_detail', args=[c.pk])
-                 for c in qs.all() if c.best_dm > 0]
-        RA = [c.ra_deg for c in qs.all() if c.best_dm > 0]
-        DEC = [c.dec_deg for c in qs.all() if c.best_dm > 0]
+        columns = scatter_columns(qs)
+        P = columns['p_bary'].tolist()
+        DM = columns['best_dm'].tolist()
+        REDCHISQ = columns['reduced_chi_sq'].tolist()
+        LINKS = detail_links(columns['pk'])
+        RA = columns['ra_deg'].tolist()
+        DEC = columns['dec_deg'].tolist()
 
         if P:
-            max_redchisq = max(REDCHISQ)
-            min_redchisq = min(REDCHISQ)
+            min_redchisq, max_redchisq = gradient_range(
+                context, columns, 'reduced_chi_sq')
             # Main panel showing candidate period-DM scatter plot:
             pc = PlotContainer(0, -20, 880, 550, color='black', x_log=True,
                                y_log=True, data_background_color='gray')
@@ -84,25 +174,28 @@ def do_candidate_graph(parser, token):
 register.tag('candidate_graph', do_candidate_graph)
 
 
-class ChiSquareCandidateGraphNode(template.Node):
+class ChiSquareCandidateGraphNode(CachedPlotNode):
     def __init__(self, var_name):
         self.var_name = var_name
 
-    def render(self, context):
+    def render_plot(self, context):
         qs = context[self.var_name]
-
-        P = [c.p_bary for c in qs.all() if c.best_dm > 0]
-        DM = [c.best_dm for c in qs.all() if c.best_dm > 0]
-        REDCHISQ = [c.reduced_chi_sq for c in qs.all() if c.best_dm > 0]
-        LINKS = [reverse('bestprof_detail', args=[c.pk])
-                 for c in qs.all() if c.best_dm > 0]
-        RA = [c.ra_deg for c in qs.all() if c.best_dm > 0]
-        DEC = [c.dec_deg for c in qs.all() if c.best_dm > 0]
+        if context.get('density'):
+            return render_density(qs, context, 'reduced_chi_sq',
+                                  'Reduced Chi Square', 'best_dm',
+                                  'Dispersion Measure cm^-3 pc')
+
+        columns = scatter_columns(qs)
+        P = columns['p_bary'].tolist()
+        DM = columns['best_dm'].tolist()
+        REDCHISQ = columns['reduced_chi_sq'].tolist()
+        LINKS = detail_links(columns['pk'])
+        RA = columns['ra_deg'].tolist()
+        DEC = columns['dec_deg'].tolist()
 
         cv = SVGCanvas(940, 550, background_color='white')
         if P:
-            lo_dm = min(DM)
-            max_dm = max(DM)
+            lo_dm, max_dm = gradient_range(context, columns, 'best_dm')
             pc = PlotContainer(0, -20, 880, 550, color='black', x_log=True,
                                y_log=True, data_background_color='gray')
             gr = RGBGradient((lo_dm, max_dm), (0, 0, 1), (1, 0, 0))
@@ -156,19 +249,21 @@ def do_chi_square_candidate_graph(parser, token):
 register.tag('chi_square_candidate_graph', do_chi_square_candidate_graph)
 
 
-class CandidatePHistogramNode(template.Node):
+class CandidatePHistogramNode(CachedPlotNode):
     def __init__(self, var_name):
         self.var_name = var_name
 
-    def render(self, context):
+    def render_plot(self, context):
         qs = context[self.var_name]
         tmp = StringIO.StringIO()
 
-        P = [c.p_bary for c in qs.all() if c.p_bary > 0]
+        edges, counts = density.log_histogram(qs, 'p_bary', 200)
 
         cv = SVGCanvas(940, 550, background_color='white')
-        if P:
-            binned = bin_data_log(P, 200)
+        if counts is not None:
+            # (lower edge, upper edge, count) per bin, as bin_data_log.
+            binned = [(float(edges[i]), float(edges[i + 1]), int(count))
+                      for i, count in enumerate(counts)]
             pc = PlotContainer(0, -20, 950, 550, color='black', x_log=True)
             pc.bottom.set_label('Period (ms)')
             pc.top.hide_label()
@@ -179,7 +274,7 @@ class CandidatePHistogramNode(template.Node):
             cv.add_plot_container(pc)
             # write number of candidates shown:
             tf = TextFragment(50, 520, '(Showing %d candidates.)' %
-                              len(P), color='black', font_size=15)
+                              counts.sum(), color='black', font_size=15)
             cv.add_plot_container(tf)
         else:
             tf = TextFragment(200, 200, 'No Candidates found.', color='red',
@@ -4,8 +4,41 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import base64
+import json
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import zipfile
 
+import numpy
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import FloatField, IntegerField
+from django.http import QueryDict
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from fold import bestprof
+from fold import caching
+from fold import catalog
+from fold import density
+from fold import columns
+from fold import ingest
+from fold import pagination
+from fold import plotcache
+from fold import synthetic
+from fold import tiles
+from fold.models import Bestprof, FoldedImage, DataGeneration, Tile
+from fold.models import BeamSummary, CandidateTag, pack_profile, unpack_profile
+from fold.views import summary_ranges, candidate_details, stream_pks
+from fold.views import CandidatePDMView
 
 
 class SimpleTest(TestCase):
@@ -14,3 +47,949 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+BESTPROF_TEMPLATE = '''\
+# Input file       =  test_DM26.70.dat
+# Candidate        =  ACCEL_Cand_1
+# Telescope        =  LOFAR
+# Epoch_topo       =  56000.123456789
+# Epoch_bary (MJD) =  56000.124567891
+# T_sample         =  0.00065536
+# Data Folded      =  1048576
+# Data Avg         =  100.5
+# Data StdDev      =  10.25
+# Profile Bins     =  %d
+# Profile Avg      =  1000.5
+# Profile StdDev   =  31.5
+# Reduced chi-sqr  =  5.2
+# Prob(Noise)      <  0   (~30.1 sigma)
+# Best DM          =  26.7
+# P_topo (ms)      =  714.5198 +/- 0.0012
+# P'_topo (s/s)    =  1.2e-10 +/- 3.4e-11
+# P''_topo (s/s^2) =  0 +/- 1.5e-15
+# P_bary (ms)      =  714.4874 +/- 0.0012
+# P'_bary (s/s)    =  1.2e-10 +/- 3.4e-11
+# P''_bary (s/s^2) =  0 +/- 1.5e-15
+# P_orb (s)        =  N/A
+# asin(i)/c (s)    =  N/A
+# eccentricity     =  N/A
+# w (rad)          =  N/A
+# T_peri           =  N/A
+######################################################
+'''
+
+
+def write_bestprof(path, profile, bins=None):
+    with open(path, 'w') as f:
+        f.write(BESTPROF_TEMPLATE % len(profile))
+        if bins is None:
+            bins = range(len(profile))
+        for i, value in zip(bins, profile):
+            f.write('%4d  %.7g\n' % (i, value))
+
+
+class BestprofFileTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.pfd.bestprof')
+        self.profile = [1000.5 + 10 * i for i in range(64)]
+        write_bestprof(self.filename, self.profile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse(self):
+        bpf = bestprof.BestprofFile(self.filename)
+        self.assertEqual(bpf.header.profile_bins, 64)
+        self.assertEqual(bpf.header.best_dm, 26.7)
+        self.assertEqual(bpf.header.p_bary, (714.4874, 0.0012))
+        self.assertEqual(bpf.header.prob_noise, (0.0, 30.1))
+        self.assertEqual(bpf.profile, self.profile)
+
+    def test_vectorized_parse_matches(self):
+        bpf = bestprof.BestprofFile(self.filename)
+        fast = bestprof.BestprofFile(self.filename, vectorized=True,
+                                     dtype=numpy.float32)
+        self.assertEqual(vars(fast.header), vars(bpf.header))
+        self.assertEqual(fast.profile.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(fast.profile, bpf.profile))
+
+    def test_non_consecutive_bins(self):
+        bins = range(len(self.profile))
+        bins[10] = 11
+        write_bestprof(self.filename, self.profile, bins)
+        self.assertRaises(Exception, bestprof.BestprofFile, self.filename)
+        self.assertRaises(Exception, bestprof.BestprofFile, self.filename,
+                          vectorized=True)
+
+    def test_malformed_profile_line(self):
+        with open(self.filename, 'a') as f:
+            f.write('end of profile\n')
+        bpf = bestprof.BestprofFile(self.filename)
+        fast = bestprof.BestprofFile(self.filename, vectorized=True,
+                                     dtype=numpy.float32)
+        self.assertEqual(vars(fast.header), vars(bpf.header))
+        self.assertEqual(fast.profile.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(fast.profile, self.profile))
+        _, parsed, _, _, _ = ingest.parse_fold(('test', self.filename, None))
+        self.assertTrue(numpy.allclose(parsed.profile, self.profile))
+
+    def test_parse_many(self):
+        parsed = bestprof.parse_many([self.filename, self.filename])
+        self.assertEqual(len(parsed), 2)
+        self.assertTrue(numpy.allclose(parsed[1].profile, self.profile))
+
+    def test_headers_only(self):
+        bpf = bestprof.BestprofFile(self.filename)
+        headers_only = bestprof.BestprofFile(self.filename, headers_only=True)
+        self.assertEqual(vars(headers_only.header), vars(bpf.header))
+        self.assertEqual(headers_only.profile, None)
+
+    def test_scan_headers(self):
+        write_bestprof(os.path.join(self.tmp_dir, 'a.pfd.bestprof'), [1, 2])
+        table = bestprof.scan_headers(self.tmp_dir)
+        self.assertEqual(list(table['filename']),
+                         ['a.pfd.bestprof', 'test.pfd.bestprof'])
+        self.assertEqual(list(table['profile_bins']), [2, 64])
+        self.assertEqual(list(table['p_bary_err']), [0.0012, 0.0012])
+        self.assertTrue(numpy.isnan(table['epoch_bary']).all())
+        self.assertEqual(table['telescope'][0], 'LOFAR')
+
+
+class LoadBeamTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.tmp_dir, 'in')
+        os.mkdir(self.in_dir)
+        for i in range(5):
+            bn = os.path.join(self.in_dir, 'fold_%d' % i)
+            write_bestprof(bn + '.pfd.bestprof', [1000.5 + i] * 32)
+            with open(bn + '.png', 'wb') as f:
+                f.write('not really a png %d' % i)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp_dir, 'media'),
+            INGEST_JOURNAL_DIR=os.path.join(self.tmp_dir, 'journals'))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self, *args, **kwargs):
+        call_command('loadbeam', self.in_dir, 'B1', '12:00:00', '45:00:00',
+                     *args, stdout=StringIO.StringIO(), **kwargs)
+
+    def test_load(self):
+        self.load(batch_size=2)
+        self.assertEqual(Bestprof.objects.count(), 5)
+        self.assertEqual(FoldedImage.objects.count(), 5)
+        for bp in Bestprof.objects.all():
+            self.assertEqual(bp.foldedimage_set.count(), 1)
+            self.assertEqual(len(bp.file_digest), 64)
+            self.assertEqual(bp.profile.dtype, numpy.float32)
+            self.assertEqual(len(bp.profile), 32)
+        summary = BeamSummary.objects.get(beam='B1')
+        self.assertEqual(summary.n_candidates, 5)
+        self.assertEqual(summary.range('best_dm'), (26.7, 26.7))
+        # Tiles of the P-DM map are built for the loaded beam.
+        tile = Tile.objects.get(beam='B1', zoom=0)
+        self.assertEqual(tile.n_candidates, 5)
+
+    def test_profile_fallback(self):
+        self.load()
+        Bestprof.objects.update(profile_data='')
+        bp = Bestprof.objects.all()[0]
+        self.assertEqual(len(bp.profile), 32)
+        self.assertTrue(numpy.allclose(bp.profile, bp.profile[0]))
+
+    def test_workers(self):
+        self.load(workers=2)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+    def test_duplicates(self):
+        self.load()
+        self.assertRaises(CommandError, self.load)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+    def test_duplicates_without_digest(self):
+        # Folds loaded before there were digests are found by file_hash.
+        self.load()
+        Bestprof.objects.update(file_digest=None)
+        self.assertRaises(CommandError, self.load)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+    def test_resume(self):
+        self.load()
+        # A resumed run skips everything instead of failing on duplicates.
+        self.load(resume=True)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+        FoldedImage.objects.filter(
+            bestprof__in=Bestprof.objects.all()[:2]).delete()
+        self.load(resume=True, cleanup=True)
+        self.assertEqual(Bestprof.objects.count(), 5)
+        self.assertEqual(FoldedImage.objects.count(), 5)
+        self.load(resume=True)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+        self.assertEqual(ingest.stored_basename('fold/B1/a.pfd.bestprof'),
+                         'a')
+        self.assertEqual(ingest.stored_basename('fold/B1/a.pfd_2.bestprof'),
+                         'a')
+
+    def test_watchbeam(self):
+        args = (self.in_dir, 'B1', '12:00:00', '45:00:00')
+        kwargs = {'once': True, 'settle': 0, 'stdout': StringIO.StringIO(),
+                  'stderr': StringIO.StringIO()}
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 5)
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+        bn = os.path.join(self.in_dir, 'fold_new')
+        write_bestprof(bn + '.pfd.bestprof', [2000.5] * 32)
+        call_command('watchbeam', *args, **kwargs)
+        # The .png is still missing.
+        self.assertEqual(Bestprof.objects.count(), 5)
+        with open(bn + '.png', 'wb') as f:
+            f.write('not really a png')
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 6)
+
+        # A new .png next to an unchanged .pfd.bestprof replaces the image.
+        with open(bn + '.png', 'wb') as f:
+            f.write('re-rendered png')
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 6)
+        images = FoldedImage.objects.filter(
+            bestprof=Bestprof.objects.latest('pk'))
+        self.assertEqual([image.file.read() for image in images],
+                         ['re-rendered png'])
+
+        # A changed fold whose .png cannot be read keeps its old row and is
+        # tried again.
+        old_digest = Bestprof.objects.latest('pk').file_digest
+        write_bestprof(bn + '.pfd.bestprof', [3000.5] * 32)
+        os.rename(bn + '.png', bn + '.png.keep')
+        os.mkdir(bn + '.png')
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 6)
+        self.assertTrue(Bestprof.objects.filter(
+            file_digest=old_digest).exists())
+        os.rmdir(bn + '.png')
+        os.rename(bn + '.png.keep', bn + '.png')
+        call_command('watchbeam', *args, **kwargs)
+        self.assertEqual(Bestprof.objects.count(), 6)
+        self.assertFalse(Bestprof.objects.filter(
+            file_digest=old_digest).exists())
+
+    def test_archive(self):
+        archive = os.path.join(self.tmp_dir, 'beam.tar.gz')
+        tf = tarfile.open(archive, 'w:gz')
+        tf.add(self.in_dir, 'beam')
+        tf.close()
+        self.in_dir = archive
+        self.load(workers=2)
+        self.assertEqual(Bestprof.objects.count(), 5)
+        self.assertEqual(FoldedImage.objects.count(), 5)
+        fi = FoldedImage.objects.get(file__endswith='fold_3.png')
+        self.assertEqual(fi.file.read(), 'not really a png 3')
+
+        archive = os.path.join(self.tmp_dir, 'beam.zip')
+        zf = zipfile.ZipFile(archive, 'w')
+        for name in os.listdir(os.path.join(self.tmp_dir, 'in')):
+            zf.write(os.path.join(self.tmp_dir, 'in', name), name)
+        zf.close()
+        parsed = list(bestprof.parse_archive(archive))
+        self.assertEqual(len(parsed), 5)
+        self.in_dir = archive
+        self.load(resume=True)
+        self.assertEqual(Bestprof.objects.count(), 5)
+
+
+class SyntheticFoldsTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_synthetic_folds(self):
+        basenames = synthetic.write_folds(self.tmp_dir, 5, n_bins=32,
+                                          png_size=(8, 8))
+        self.assertEqual(ingest.find_folds(self.tmp_dir), basenames)
+        for bn in basenames:
+            filename = os.path.join(self.tmp_dir, bn + '.pfd.bestprof')
+            bpf = bestprof.BestprofFile(filename, vectorized=True)
+            self.assertEqual(len(bpf.profile), 32)
+            self.assertTrue(bpf.header.p_bary[0] > 0)
+
+    def test_benchingest(self):
+        call_command('makefolds', self.tmp_dir, '10',
+                     stdout=StringIO.StringIO())
+        out = StringIO.StringIO()
+        with self.settings(MEDIA_ROOT=os.path.join(self.tmp_dir, 'media')):
+            call_command('benchingest', self.tmp_dir, json=True,
+                         chunk_size=3, batch_size=2, stdout=out)
+            self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'media',
+                                                     'fold')), [])
+        self.assertEqual(Bestprof.objects.count(), 0)
+        self.assertEqual(Tile.objects.count(), 0)
+        results = json.loads(out.getvalue())
+        self.assertEqual(results['n_folds'], 10)
+        self.assertEqual(set(results['stages']), set([
+            'read', 'parse', 'parse_text', 'hash', 'insert', 'copy']))
+
+
+class ExplainConstraintsTest(TestCase):
+    def test_index_used(self):
+        out = StringIO.StringIO()
+        call_command('explainconstraints', 'lo_dm=10', 'order=redchisq',
+                     count=True, stdout=out)
+        self.assertTrue('INDEX' in out.getvalue().upper())
+
+
+def create_bestprof(**kwargs):
+    '''
+    Create a Bestprof row without going through a .bestprof file.
+    '''
+    fields = dict((f.name, 0) for f in Bestprof._meta.fields
+                  if isinstance(f, FloatField) or isinstance(f, IntegerField))
+    fields.update({
+        'beam': 'B1',
+        'file': 'fold/B1/test.pfd.bestprof',
+        'ra': '12:00:00',
+        'dec': '45:00:00',
+        'input_file': 'test.dat',
+        'candidate': 'ACCEL_Cand_1',
+        'telescope': 'LOFAR',
+    })
+    fields.update(kwargs)
+    return Bestprof.objects.create(**fields)
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        # Duplicate chi-squared values to check the ties are broken by pk.
+        for i in range(25):
+            create_bestprof(reduced_chi_sq=i // 3, best_dm=10 + i,
+                            p_bary=1 + i)
+
+    def walk(self, order, per_page):
+        qs = Bestprof.objects.all()
+        pages = []
+        cursor = ''
+        while True:
+            page = pagination.keyset_page(qs, order, cursor, per_page)
+            pages.append([bp.pk for bp in page.object_list])
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        return pages, page
+
+    def test_pages(self):
+        for order, expected in [
+                ('pk', Bestprof.objects.order_by('pk')),
+                ('redchisq', Bestprof.objects.order_by('-reduced_chi_sq',
+                                                       'pk'))]:
+            expected = [bp.pk for bp in expected]
+            pages, last_page = self.walk(order, 4)
+            self.assertEqual(sum(pages, []), expected)
+            self.assertEqual(len(pages), 7)
+
+            # And back again.
+            back = [pages[-1]]
+            page = last_page
+            while page.has_previous():
+                page = pagination.keyset_page(
+                    Bestprof.objects.all(), order, page.previous_cursor, 4)
+                back.insert(0, [bp.pk for bp in page.object_list])
+            self.assertEqual(back, pages)
+
+    def test_invalid_cursor(self):
+        for decoded in ['{}', '[]', '"n"', '["x", 1]', '["n", [1]]',
+                        '["n", {"a": 1}]']:
+            cursor = base64.urlsafe_b64encode(decoded)
+            self.assertRaises(ValueError, pagination.decode_cursor, cursor)
+            response = self.client.get(reverse('bestprof_list'),
+                                       {'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+        self.assertRaises(ValueError, pagination.decode_cursor, 'not base64')
+
+    def test_view(self):
+        response = self.client.get(reverse('bestprof_list'),
+                                   {'cursor': '', 'order': 'redchisq'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['keyset'])
+        self.assertEqual(len(response.context['object_list']), 25)
+        response = self.client.get(reverse('bestprof_list'),
+                                   {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class CachedCountTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(110):
+            create_bestprof(reduced_chi_sq=i, best_dm=10 + i, p_bary=1 + i)
+
+    def test_signature(self):
+        a = caching.constraint_signature(
+            QueryDict('lo_dm=10&order=redchisq&tag=a&tag=b'))
+        b = caching.constraint_signature(QueryDict('tag=a&tag=b&lo_dm=10'))
+        self.assertEqual(a, b)
+        # Only the last tag is used for the selection.
+        c = caching.constraint_signature(QueryDict('tag=b&tag=a&lo_dm=10'))
+        self.assertNotEqual(a, c)
+        self.assertEqual(a, caching.constraint_signature(
+            QueryDict('tag=b&lo_dm=10')))
+
+    def test_cached_count(self):
+        url = reverse('bestprof_list')
+        response = self.client.get(url, {'lo_dm': '20'})
+        self.assertEqual(response.context['paginator'].count, 100)
+        # The second page reuses the count of the first.
+        connection.use_debug_cursor = True
+        try:
+            n_queries = len(connection.queries)
+            response = self.client.get(url, {'lo_dm': '20', 'page': '2'})
+            queries = connection.queries[n_queries:]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        self.assertEqual(response.context['paginator'].count, 100)
+
+        generation = DataGeneration.objects.current()
+        create_bestprof(reduced_chi_sq=100, best_dm=100, p_bary=100)
+        self.assertTrue(DataGeneration.objects.current() > generation)
+        response = self.client.get(url, {'lo_dm': '20'})
+        self.assertEqual(response.context['paginator'].count, 101)
+
+
+class ColumnsTest(TestCase):
+    def test_scatter_columns(self):
+        bps = [create_bestprof(reduced_chi_sq=i, best_dm=i - 2, p_bary=1 + i)
+               for i in range(6)]
+        qs = Bestprof.objects.order_by('pk')
+        with self.assertNumQueries(1):
+            cols = columns.scatter_columns(qs)
+        self.assertEqual(cols['pk'].tolist(), [bp.pk for bp in bps[3:]])
+        self.assertEqual(cols['best_dm'].tolist(), [1, 2, 3])
+        self.assertEqual(cols['p_bary'].tolist(), [4, 5, 6])
+        self.assertEqual(columns.detail_links(cols['pk']),
+                         [reverse('bestprof_detail', args=[bp.pk])
+                          for bp in bps[3:]])
+
+        cols = columns.load_columns(qs[:2], ['pk', 'p_bary'])
+        self.assertEqual(cols['p_bary'].tolist(), [1, 2])
+
+    def test_load_column(self):
+        for i in range(4):
+            create_bestprof(p_bary=i)
+        qs = Bestprof.objects.with_constraints(QueryDict('order=redchisq'))
+        with self.assertNumQueries(1):
+            P = columns.load_column(qs.filter(p_bary__gt=0), 'p_bary')
+        self.assertEqual(P.dtype, numpy.float64)
+        self.assertEqual(sorted(P.tolist()), [1, 2, 3])
+
+
+    def test_iter_chunks(self):
+        for i in range(5):
+            create_bestprof(best_dm=i)
+        qs = Bestprof.objects.filter(best_dm__gt=0)
+        with self.assertNumQueries(2):
+            chunks = list(columns.iter_chunks(qs, ['best_dm'], chunk_size=3))
+        self.assertEqual([c['best_dm'].tolist() for c in chunks],
+                         [[1, 2, 3], [4]])
+        self.assertEqual(chunks[0]['pk'].dtype, numpy.int64)
+
+
+class PlotCacheTest(TestCase):
+    def test_eviction(self):
+        cache = plotcache.PlotCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.set('c', 'cccc')
+        # b was used least recently
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.n_bytes, 8)
+        cache.set('d', 'd' * 11)
+        self.assertEqual(cache.get('d'), None)
+
+        calls = []
+
+        def render():
+            calls.append(1)
+            return '<svg/>'
+        self.assertEqual(plotcache.cached_plot('key', render), '<svg/>')
+        self.assertEqual(plotcache.cached_plot('key', render), '<svg/>')
+        self.assertEqual(len(calls), 1)
+        plotcache.PLOT_CACHE.clear()
+
+    def test_not_modified(self):
+        create_bestprof(best_dm=30, p_bary=1)
+        key = plotcache.plot_key('pdm', QueryDict('lo_dm=20&page=2'))
+        self.assertNotEqual(key, plotcache.plot_key(
+            'pchi', QueryDict('lo_dm=20&page=2')))
+        response = self.client.get(reverse('candidate_pdm_graph'),
+                                   {'lo_dm': '20', 'page': '2'},
+                                   HTTP_IF_NONE_MATCH='"%s-"' % key)
+        self.assertEqual(response.status_code, 304)
+
+        create_bestprof(best_dm=40, p_bary=2)
+        self.assertNotEqual(key, plotcache.plot_key(
+            'pdm', QueryDict('lo_dm=20&page=2')))
+
+
+class DensityTest(TestCase):
+    def test_bin_log2d(self):
+        p = numpy.array([1, 1, 10, 100, 100, 100.])
+        dm = numpy.array([1, 1, 10, 100, 100, 100.])
+        chi = numpy.array([1, 2, 3, 4, 6, 5.])
+        x_edges, y_edges, counts, maxima = density.bin_log2d(p, dm, chi,
+                                                             bins=(2, 2))
+        self.assertTrue(numpy.allclose(x_edges, [1, 10, 100]))
+        cells = list(density.iter_cells(x_edges, y_edges, counts, maxima))
+        self.assertEqual([c[4:] for c in cells], [(2, 2), (4, 6)])
+
+        url = density.cell_link('/folds/', '?tag=a', 'p_bary', 'best_dm',
+                                cells[0])
+        qd = QueryDict(url.split('?')[1])
+        self.assertEqual(qd['tag'], 'a')
+        self.assertEqual(float(qd['lo_p']), 1)
+        self.assertTrue(float(qd['hi_dm']) < 10)
+
+    def test_cell_link_counts(self):
+        # The candidates at 10 are on the edge between two cells.
+        values = [1, 3, 10, 10, 30, 100]
+        for p in values:
+            for dm in values:
+                create_bestprof(p_bary=p, best_dm=dm)
+        p = dm = numpy.array(values, dtype=float)
+        grid = density.bin_log2d(numpy.repeat(p, 6), numpy.tile(dm, 6),
+                                 bins=(2, 2))
+        cells = list(density.iter_cells(*grid))
+        self.assertEqual([c[4] for c in cells], [4, 8, 8, 16])
+        for cell in cells:
+            url = density.cell_link('/folds/', '', 'p_bary', 'best_dm', cell,
+                                    (grid[0][-1], grid[1][-1]))
+            qd = QueryDict(url.split('?')[1])
+            self.assertEqual(
+                Bestprof.objects.with_constraints(qd).count(), cell[4])
+
+    def test_bin_queryset(self):
+        self.assertEqual(density.bin_queryset(Bestprof.objects.all(),
+                                              'p_bary', 'best_dm'), None)
+        p = [1, 3, 10, 30, 100, 0]
+        dm = [2, 20, 10, 5, 50, 7]
+        chi = [1, 5, 2, 4, 3, 9]
+        for args in zip(p, dm, chi):
+            create_bestprof(p_bary=args[0], best_dm=args[1],
+                            reduced_chi_sq=args[2])
+        old_iter_chunks = density.iter_chunks
+        density.iter_chunks = lambda qs, fields: old_iter_chunks(qs, fields,
+                                                                 chunk_size=2)
+        try:
+            grid = density.bin_queryset(Bestprof.objects.all(), 'p_bary',
+                                        'best_dm', 'reduced_chi_sq',
+                                        bins=(3, 2))
+        finally:
+            density.iter_chunks = old_iter_chunks
+        expected = density.bin_log2d(numpy.array(p[:5], dtype=float),
+                                     numpy.array(dm[:5], dtype=float),
+                                     numpy.array(chi[:5], dtype=float),
+                                     bins=(3, 2))
+        for got, want in zip(grid, expected):
+            self.assertEqual(got.tolist(), want.tolist())
+
+    def test_log_histogram(self):
+        self.assertEqual(density.log_histogram(Bestprof.objects.all(),
+                                               'p_bary', 2), (None, None))
+        for p in [0, 1, 2, 50, 100, 100]:
+            create_bestprof(p_bary=p)
+        old_iter_chunks = density.iter_chunks
+        density.iter_chunks = lambda qs, fields: old_iter_chunks(qs, fields,
+                                                                 chunk_size=2)
+        try:
+            edges, counts = density.log_histogram(Bestprof.objects.all(),
+                                                  'p_bary', 2)
+        finally:
+            density.iter_chunks = old_iter_chunks
+        self.assertTrue(numpy.allclose(edges, [1, 10, 100]))
+        self.assertEqual(counts.tolist(), [2, 3])
+
+    def test_switch(self):
+        for i in range(5):
+            create_bestprof(best_dm=1 + i, p_bary=1 + i)
+        factory = RequestFactory()
+
+        def use_density(**get_pars):
+            view = CandidatePDMView(density_threshold=3)
+            view.request = factory.get('/', get_pars)
+            return view.use_density()
+        self.assertTrue(use_density())
+        self.assertFalse(use_density(lo_dm='3'))
+        self.assertFalse(use_density(page='1'))
+        self.assertFalse(use_density(mode='scatter'))
+        self.assertTrue(use_density(lo_dm='3', mode='density'))
+
+
+class TilesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        create_bestprof(beam='B1', p_bary=1.5, best_dm=20, reduced_chi_sq=2)
+        create_bestprof(beam='B1', p_bary=1.5, best_dm=20, reduced_chi_sq=5)
+        create_bestprof(beam='B2', p_bary=1.5, best_dm=20, reduced_chi_sq=3)
+        create_bestprof(beam='B2', p_bary=700, best_dm=30, reduced_chi_sq=1)
+        create_bestprof(beam='B2', p_bary=700, best_dm=0, reduced_chi_sq=1)
+        call_command('buildtiles', stdout=StringIO.StringIO())
+
+    def test_bin_tiles(self):
+        binned = tiles.bin_tiles(numpy.array([1., 1000.]),
+                                 numpy.array([1., 1000.]),
+                                 numpy.array([2., 3.]), 1)
+        # log10 P and DM run from -1 to 4, 128 cells at zoom 1.
+        self.assertEqual(binned, {(0, 0): [[25, 25, 1, 2.0]],
+                                  (1, 1): [[38, 38, 1, 3.0]]})
+
+    def test_stored_tiles(self):
+        self.assertEqual(Tile.objects.filter(zoom=0).count(), 2)
+        tile = tiles.get_tile(0, 0, 0)
+        self.assertEqual([cell[2:] for cell in tile['cells']],
+                         [[3, 5.0], [1, 1.0]])
+        tile = tiles.get_tile(0, 0, 0, beam='B1')
+        self.assertEqual([cell[2:] for cell in tile['cells']], [[2, 5.0]])
+
+    def test_add_candidates(self):
+        def stored(beam):
+            return sorted((t.zoom, t.x, t.y, t.n_candidates,
+                           json.loads(t.cells))
+                          for t in Tile.objects.filter(beam=beam))
+        new = [create_bestprof(beam='B2', p_bary=1.5, best_dm=20,
+                               reduced_chi_sq=9),
+               create_bestprof(beam='B2', p_bary=3000, best_dm=2,
+                               reduced_chi_sq=1)]
+        with self.assertNumQueries(0):
+            tiles.add_candidates('B2', [])
+        tiles.add_candidates('B2', new)
+        merged = stored('B2')
+        tiles.build_beam_tiles('B2')
+        self.assertEqual(merged, stored('B2'))
+        tile = tiles.get_tile(0, 0, 0, beam='B2')
+        self.assertTrue([15, 29, 2, 9.0] in tile['cells'])
+
+    def test_points(self):
+        zoom = tiles.MAX_STORED_ZOOM + 1
+        n = 2 ** zoom
+        x = int((numpy.log10(700) + 1) / 5 * n)
+        y = int((numpy.log10(30) + 1) / 5 * n)
+        tile = tiles.get_tile(zoom, x, y)
+        pk = Bestprof.objects.get(best_dm=30).pk
+        self.assertEqual(tile['points'], [(pk, 700, 30, 1)])
+
+        old_max_points = tiles.MAX_POINTS
+        tiles.MAX_POINTS = 0
+        try:
+            tile = tiles.get_tile(zoom, x, y)
+        finally:
+            tiles.MAX_POINTS = old_max_points
+        self.assertEqual([cell[2:] for cell in tile['cells']], [[1, 1.0]])
+
+    def test_view(self):
+        url = reverse('candidate_tile', args=[0, 0, 0])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['cells']), 2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse('candidate_tile', args=[0, 1, 0]))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('candidate_pdm_map'))
+        self.assertEqual(response.status_code, 200)
+
+
+class BeamSummaryTest(TestCase):
+    def test_summary(self):
+        bps = [create_bestprof(beam='B1', p_bary=i + 1, best_dm=10 * i,
+                               reduced_chi_sq=i) for i in range(3)]
+        create_bestprof(beam='B2', p_bary=100, best_dm=5, reduced_chi_sq=9)
+        summary = BeamSummary.objects.get(beam='B1')
+        self.assertEqual(summary.n_candidates, 3)
+        self.assertEqual(summary.range('p_bary'), (1, 3))
+
+        bps[0].tags.add('rfi')
+        bps[1].tags.add('rfi', 'pulsar')
+        summary = BeamSummary.objects.get(beam='B1')
+        self.assertEqual(summary.tag_counts, [('pulsar', 1), ('rfi', 2)])
+        bps[1].tags.remove('rfi')
+        self.assertEqual(BeamSummary.objects.get(beam='B1').tag_counts,
+                         [('pulsar', 1), ('rfi', 1)])
+
+        bps[2].delete()
+        summary = BeamSummary.objects.get(beam='B1')
+        self.assertEqual(summary.n_candidates, 2)
+        self.assertEqual(summary.range('p_bary'), (1, 2))
+
+        totals = BeamSummary.objects.totals()
+        self.assertEqual(totals.n_candidates, 3)
+        self.assertEqual(totals.range('reduced_chi_sq'), (0, 9))
+        self.assertEqual(totals.tag_counts, [('pulsar', 1), ('rfi', 1)])
+
+        self.assertEqual(summary_ranges(QueryDict('order=redchisq'))
+                         ['best_dm'], (0, 10))
+        self.assertEqual(summary_ranges(QueryDict('beam=B2'))['best_dm'],
+                         (5, 5))
+        self.assertEqual(summary_ranges(QueryDict('lo_dm=3')), None)
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('beam_list'))
+        self.assertContains(response, 'pulsar (1)')
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, '3 candidates')
+
+
+class BatchDetailTest(TestCase):
+    def test_batch(self):
+        bps = [create_bestprof() for i in range(4)]
+        for bp in bps[:3]:
+            FoldedImage.objects.create(beam='B1', bestprof=bp,
+                                       file='fold/B1/%d.png' % bp.pk)
+        bps[1].tags.add('rfi', 'pulsar')
+        pks = [bps[2].pk, bps[1].pk, bps[3].pk, bps[3].pk + 100]
+        candidate_details(pks)
+        with self.assertNumQueries(3):
+            details = candidate_details(pks)
+        self.assertEqual([d['pk'] for d in details], pks[:3])
+        self.assertEqual(details[1]['tags'], ['pulsar', 'rfi'])
+        self.assertTrue(details[0]['img'].endswith('/%d.png' % bps[2].pk))
+        self.assertEqual(details[2]['img'], None)
+
+        url = reverse('bestprof_batch')
+        response = self.client.get(url, {'pks': '%d,%d' % tuple(pks[:2])})
+        self.assertEqual([d['pk'] for d in json.loads(response.content)],
+                         pks[:2])
+        response = self.client.get(url, {'pks': 'a,b'})
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamPksTest(TestCase):
+    def test_stream(self):
+        pks = [create_bestprof(best_dm=i, reduced_chi_sq=i % 3).pk
+               for i in range(10)]
+        with self.assertNumQueries(4):
+            lines = list(stream_pks(Bestprof.objects.all(), first_chunk=2,
+                                    max_chunk=4))
+        self.assertEqual([json.loads(line) for line in lines],
+                         [pks[:2], pks[2:6], pks[6:10]])
+        lines = list(stream_pks(Bestprof.objects.all(), 'redchisq',
+                                first_chunk=2, max_chunk=4))
+        expected = sorted(pks, key=lambda pk: (-((pk - pks[0]) % 3), pk))
+        self.assertEqual(sum([json.loads(line) for line in lines], []),
+                         expected)
+
+        response = self.client.get(reverse('bestprof_list'),
+                                   {'stream': '1', 'lo_dm': '5'},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(sum([json.loads(line) for line in lines], []),
+                         pks[5:])
+
+
+class BulkTagTest(TestCase):
+    def setUp(self):
+        self.bps = [create_bestprof(beam='B1', best_dm=i) for i in range(10)]
+
+    def tagged(self, name):
+        return sorted(Bestprof.objects.filter(tags__name=name).values_list(
+            'best_dm', flat=True))
+
+    def test_bulk_tag(self):
+        self.bps[0].tags.add('rfi')
+        generation = DataGeneration.objects.current()
+        qs = Bestprof.objects.with_constraints(QueryDict('hi_dm=4'))
+        self.assertEqual(Bestprof.objects.bulk_tag('rfi', qs=qs,
+                                                   batch_size=2), 4)
+        self.assertEqual(self.tagged('rfi'), [0, 1, 2, 3, 4])
+        self.assertTrue(DataGeneration.objects.current() > generation)
+        self.assertEqual(BeamSummary.objects.get(beam='B1').tag_counts,
+                         [('rfi', 5)])
+
+        pks = [bp.pk for bp in self.bps[3:7]]
+        self.assertEqual(Bestprof.objects.bulk_tag('rfi', pks=pks,
+                                                   remove=True), 2)
+        self.assertEqual(self.tagged('rfi'), [0, 1, 2])
+        self.assertEqual(BeamSummary.objects.get(beam='B1').tag_counts,
+                         [('rfi', 3)])
+        self.assertEqual(Bestprof.objects.bulk_tag('nope', pks=pks,
+                                                   remove=True), 0)
+
+    def test_view(self):
+        url = reverse('bestprof_bulk_tag')
+        response = self.client.post(url, {'tag': 'pulsar'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url + '?lo_dm=8', {'tag': 'pulsar'})
+        self.assertEqual(json.loads(response.content)['added'], 2)
+        response = self.client.post(url, {'tag': 'pulsar', 'remove': '1',
+                                          'pks': str(self.bps[9].pk)})
+        self.assertEqual(json.loads(response.content)['removed'], 1)
+        self.assertEqual(self.tagged('pulsar'), [8])
+
+    def test_command(self):
+        out = StringIO.StringIO()
+        call_command('bulktag', 'rfi', selection='lo_dm=5&hi_dm=6',
+                     stdout=out)
+        self.assertEqual(self.tagged('rfi'), [5, 6])
+        call_command('bulktag', 'rfi', str(self.bps[5].pk), remove=True,
+                     stdout=out)
+        self.assertEqual(self.tagged('rfi'), [6])
+        self.assertRaises(CommandError, call_command, 'bulktag', 'rfi',
+                          stdout=out)
+
+
+class CandidateTagTest(TestCase):
+    def test_sync(self):
+        bps = [create_bestprof(best_dm=i) for i in range(4)]
+        bps[0].tags.add('rfi', 'pulsar')
+        bps[1].tags.add('rfi')
+        Bestprof.objects.bulk_tag('rfi', pks=[bps[2].pk])
+        bps[0].tags.remove('pulsar')
+        self.assertEqual(CandidateTag.objects.tag_names(
+            [bp.pk for bp in bps]), {bps[0].pk: ['rfi'], bps[1].pk: ['rfi'],
+                                     bps[2].pk: ['rfi'], bps[3].pk: []})
+        Bestprof.objects.bulk_tag('rfi', pks=[bps[1].pk], remove=True)
+
+        qs = Bestprof.objects.with_constraints(
+            QueryDict('tag=rfi&order=redchisq'))
+        self.assertEqual(sorted(bp.pk for bp in qs), [bps[0].pk, bps[2].pk])
+        self.assertTrue('fold_candidatetag' in str(qs.query))
+
+        CandidateTag.objects.all().delete()
+        call_command('synctags', stdout=StringIO.StringIO())
+        self.assertEqual(CandidateTag.objects.count(), 2)
+
+    def test_list_tags(self):
+        for i in range(5):
+            create_bestprof(best_dm=i).tags.add('rfi', 'x%d' % i)
+        response = self.client.get(reverse('bestprof_list'))
+        self.assertContains(response, 'rfi x3 ')
+        self.assertEqual(response.context['object_list'][0].tag_names,
+                         ['rfi', 'x0'])
+
+
+class CandidateColumnsTest(TestCase):
+    def setUp(self):
+        self.bps = [create_bestprof(best_dm=i, p_bary=0.1 * i,
+                                    profile_bins=i) for i in range(7)]
+        self.url = reverse('candidate_columns')
+
+    def get(self, **get_pars):
+        response = self.client.get(self.url, get_pars)
+        self.assertEqual(response.status_code, 200)
+        return ''.join(response.streaming_content)
+
+    def test_json(self):
+        old_chunk_size = columns.CHUNK_SIZE
+        columns.CHUNK_SIZE = 3
+        try:
+            content = json.loads(self.get(fields='pk,p_bary,profile_bins',
+                                          lo_dm='1', limit='4'))
+        finally:
+            columns.CHUNK_SIZE = old_chunk_size
+        self.assertEqual(content['n_rows'], 4)
+        self.assertEqual([c['n_rows'] for c in content['chunks']], [3, 1])
+
+        def column(field):
+            return sum([c['columns'][field] for c in content['chunks']], [])
+        self.assertEqual(column('pk'), [bp.pk for bp in self.bps[1:5]])
+        self.assertEqual(column('p_bary'), [0.1 * i for i in range(1, 5)])
+        self.assertEqual(column('profile_bins'), [1, 2, 3, 4])
+        self.assertEqual(content['next'], self.bps[4].pk)
+
+        content = json.loads(self.get(fields='best_dm', lo_dm='1',
+                                      after=str(content['next'])))
+        self.assertEqual(content['chunks'],
+                         [{'n_rows': 2, 'columns': {'best_dm': [5, 6]}}])
+        self.assertEqual(content['next'], None)
+
+    def test_binary(self):
+        old_chunk_size = columns.CHUNK_SIZE
+        columns.CHUNK_SIZE = 3
+        try:
+            content = self.get(fields='pk,best_dm', format='binary')
+        finally:
+            columns.CHUNK_SIZE = old_chunk_size
+        header, data = content.split('\n', 1)
+        header = json.loads(header)
+        self.assertEqual(header['dtypes'], ['<i8', '<f8'])
+        self.assertEqual(header['next'], None)
+        pks, dms, sizes = [], [], []
+        while True:
+            n = numpy.frombuffer(data[:8], dtype='<i8')[0]
+            data = data[8:]
+            if not n:
+                break
+            sizes.append(n)
+            pks.extend(numpy.frombuffer(data[:8 * n], dtype='<i8'))
+            dms.extend(numpy.frombuffer(data[8 * n:16 * n], dtype='<f8'))
+            data = data[16 * n:]
+        self.assertEqual(data, '')
+        self.assertEqual(sizes, [3, 3, 1])
+        self.assertEqual(pks, [bp.pk for bp in self.bps])
+        self.assertEqual(dms, range(7))
+
+    def test_errors(self):
+        for get_pars in [{'fields': 'beam'}, {'limit': '0'},
+                         {'format': 'xml'}, {'after': 'x'}]:
+            response = self.client.get(self.url, get_pars)
+            self.assertEqual(response.status_code, 400)
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for i in range(5):
+            bp = create_bestprof(beam='B1', best_dm=i, p_bary=i + 1,
+                                 file_hash=i, file_digest='%064d' % i,
+                                 profile_data=pack_profile(range(i + 1)))
+            if i % 2:
+                bp.tags.add('rfi')
+        create_bestprof(beam='B2', file_hash=10, file_digest=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def round_trip(self, path):
+        self.assertEqual(catalog.export_catalog(
+            Bestprof.objects.filter(beam='B1'), path), 5)
+        Bestprof.objects.filter(pk=Bestprof.objects.get(best_dm=3).pk).delete()
+        self.assertEqual(catalog.import_catalog(path, batch_size=2), (1, 4))
+        bp = Bestprof.objects.get(best_dm=3)
+        self.assertEqual(unpack_profile(bp.profile_data).tolist(), range(4))
+        self.assertEqual(list(bp.tags.names()), ['rfi'])
+        self.assertEqual(BeamSummary.objects.get(beam='B1').tag_counts,
+                         [('rfi', 2)])
+        self.assertEqual(catalog.import_catalog(path), (0, 5))
+        self.assertEqual(Bestprof.objects.filter(beam='B1').count(), 5)
+
+    def test_npz(self):
+        self.round_trip(os.path.join(self.tmp_dir, 'catalog.npz'))
+
+    def test_directory(self):
+        path = os.path.join(self.tmp_dir, 'catalog')
+        self.round_trip(path)
+        arrays = catalog.load_catalog(path)
+        self.assertTrue(isinstance(arrays['best_dm'], numpy.memmap))
+        self.assertEqual(arrays['best_dm'].tolist(), range(5))
+
+    def test_without_digest(self):
+        path = os.path.join(self.tmp_dir, 'catalog.npz')
+        catalog.export_catalog(Bestprof.objects.filter(beam='B2'), path,
+                               profiles=False)
+        self.assertEqual(catalog.import_catalog(path), (0, 1))
+        Bestprof.objects.filter(beam='B2').delete()
+        self.assertEqual(catalog.import_catalog(path), (1, 0))
+        self.assertEqual(Bestprof.objects.get(beam='B2').file_hash, 10)
@@ -0,0 +1,200 @@
+'''
+Tiles of a zoomable map of the P-DM plane.
+
+The plane (log10 of the period in ms against log10 of the DM) is split in
+2**zoom by 2**zoom tiles at every zoom level, every tile is divided in
+TILE_SIZE by TILE_SIZE cells. Tiles up to MAX_STORED_ZOOM only contain the
+number of candidates (and the maximum reduced chi-square) per cell, they
+are precomputed per beam and stored as Tile rows. Newly loaded candidates
+are merged into the stored tiles (see add_candidates), only deletions need
+a rebuild of the tiles of a beam. Deeper tiles are made on request and list
+the individual candidates, unless there are too many.
+'''
+import numpy
+from django.db import transaction
+from django.utils import simplejson
+
+from columns import load_columns, iter_chunks
+from models import Bestprof, Tile, DataGeneration
+
+# Extent of the map in log10(P / ms) and log10(DM / cm^-3 pc).
+LOG_P_RANGE = (-1.0, 4.0)
+LOG_DM_RANGE = (-1.0, 4.0)
+TILE_SIZE = 64
+MAX_STORED_ZOOM = 5
+MAX_ZOOM = 12
+# Fine tiles with more candidates than this are binned as well.
+MAX_POINTS = 2000
+
+TILE_COLUMNS = ('pk', 'p_bary', 'best_dm', 'reduced_chi_sq')
+
+
+def tile_bounds(zoom, x, y):
+    '''
+    Return (lo_p, hi_p, lo_dm, hi_dm) of a tile, y counts upwards in DM.
+    '''
+    n_tiles = 2 ** zoom
+    p_step = (LOG_P_RANGE[1] - LOG_P_RANGE[0]) / n_tiles
+    dm_step = (LOG_DM_RANGE[1] - LOG_DM_RANGE[0]) / n_tiles
+    return (10 ** (LOG_P_RANGE[0] + x * p_step),
+            10 ** (LOG_P_RANGE[0] + (x + 1) * p_step),
+            10 ** (LOG_DM_RANGE[0] + y * dm_step),
+            10 ** (LOG_DM_RANGE[0] + (y + 1) * dm_step))
+
+
+def valid_tile(zoom, x, y):
+    return 0 <= zoom <= MAX_ZOOM and 0 <= x < 2 ** zoom and \
+        0 <= y < 2 ** zoom
+
+
+def _map_columns(columns):
+    # Only candidates that can be shown on the (logarithmic) map.
+    mask = (columns['p_bary'] > 0) & (columns['best_dm'] > 0)
+    return dict((field, values[mask]) for field, values in columns.items())
+
+
+def bin_tiles(p, dm, chi, zoom):
+    '''
+    Bin candidates into the cells of all tiles at a zoom level.
+
+    Returns a dictionary mapping (x, y) of the non empty tiles to a list of
+    [cell x, cell y, count, max. reduced chi-square] for their non empty
+    cells.
+    '''
+    n_cells = 2 ** zoom * TILE_SIZE
+    ix = numpy.floor((numpy.log10(p) - LOG_P_RANGE[0]) /
+                     (LOG_P_RANGE[1] - LOG_P_RANGE[0]) * n_cells)
+    iy = numpy.floor((numpy.log10(dm) - LOG_DM_RANGE[0]) /
+                     (LOG_DM_RANGE[1] - LOG_DM_RANGE[0]) * n_cells)
+    inside = (ix >= 0) & (ix < n_cells) & (iy >= 0) & (iy < n_cells)
+    flat = ix[inside].astype(numpy.int64) * n_cells + \
+        iy[inside].astype(numpy.int64)
+
+    tiles = {}
+    if not len(flat):
+        return tiles
+    cell_ids, inverse, counts = numpy.unique(flat, return_inverse=True,
+                                             return_counts=True)
+    maxima = numpy.empty(len(cell_ids))
+    maxima.fill(-numpy.inf)
+    numpy.maximum.at(maxima, inverse, chi[inside])
+    for cell_id, count, maximum in zip(cell_ids.tolist(), counts.tolist(),
+                                       maxima.tolist()):
+        cx, cy = divmod(cell_id, n_cells)
+        tiles.setdefault((cx // TILE_SIZE, cy // TILE_SIZE), []).append(
+            [cx % TILE_SIZE, cy % TILE_SIZE, count, maximum])
+    return tiles
+
+
+def merge_cells(cell_lists):
+    '''
+    Merge the cells of the same tile for several beams.
+    '''
+    merged = {}
+    for cells in cell_lists:
+        for cx, cy, count, maximum in cells:
+            if (cx, cy) in merged:
+                old = merged[cx, cy]
+                merged[cx, cy] = [cx, cy, old[2] + count,
+                                  max(old[3], maximum)]
+            else:
+                merged[cx, cy] = [cx, cy, count, maximum]
+    return sorted(merged.values())
+
+
+def _merge_columns(beam, columns, batch_size=500):
+    # Merge binned candidates into the stored tiles of beam, the caller
+    # takes care of the transaction.
+    columns = _map_columns(columns)
+    if not len(columns['p_bary']):
+        return
+    new_tiles = []
+    for zoom in range(MAX_STORED_ZOOM + 1):
+        binned = bin_tiles(columns['p_bary'], columns['best_dm'],
+                           columns['reduced_chi_sq'], zoom)
+        if not binned:
+            continue
+        stored = dict(((tile.x, tile.y), tile) for tile in Tile.objects.filter(
+            beam=beam, zoom=zoom, x__in=set(x for x, _ in binned),
+            y__in=set(y for _, y in binned)))
+        for (x, y), cells in binned.iteritems():
+            tile = stored.get((x, y))
+            if tile is None:
+                tile = Tile(beam=beam, zoom=zoom, x=x, y=y)
+                new_tiles.append(tile)
+            else:
+                cells = merge_cells([simplejson.loads(tile.cells), cells])
+            tile.n_candidates = sum(cell[2] for cell in cells)
+            tile.cells = simplejson.dumps(cells)
+            if tile.pk is not None:
+                tile.save()
+    for i in range(0, len(new_tiles), batch_size):
+        Tile.objects.bulk_create(new_tiles[i:i + batch_size])
+
+
+def add_candidates(beam, bestprofs):
+    '''
+    Merge newly loaded Bestprof instances into the stored tiles of beam
+    (counts add up and maxima are kept), call this inside the transaction
+    that writes them.
+    '''
+    if not bestprofs:
+        return
+    _merge_columns(beam, dict(
+        (field, numpy.array([getattr(bp, field) for bp in bestprofs],
+                            dtype=numpy.float64))
+        for field in TILE_COLUMNS if field != 'pk'))
+
+
+def build_beam_tiles(beam):
+    '''
+    Recompute the stored tiles of one beam from scratch (needed after
+    candidates were removed), returns the number of tiles.
+    '''
+    with transaction.commit_on_success():
+        Tile.objects.filter(beam=beam).delete()
+        for chunk in iter_chunks(Bestprof.objects.filter(beam=beam),
+                                 TILE_COLUMNS):
+            _merge_columns(beam, chunk)
+    # Tiles served before the rebuild may be cached.
+    DataGeneration.objects.bump()
+    return Tile.objects.filter(beam=beam).count()
+
+
+def get_tile(zoom, x, y, beam=None):
+    '''
+    Return the contents of a tile as a dictionary (see module docstring),
+    with either cells or points ([pk, P, DM, reduced chi-square]).
+    '''
+    lo_p, hi_p, lo_dm, hi_dm = tile_bounds(zoom, x, y)
+    tile = {
+        'zoom': zoom, 'x': x, 'y': y, 'tile_size': TILE_SIZE,
+        'bounds': [lo_p, hi_p, lo_dm, hi_dm],
+    }
+
+    if zoom <= MAX_STORED_ZOOM:
+        qs = Tile.objects.filter(zoom=zoom, x=x, y=y)
+        if beam is not None:
+            qs = qs.filter(beam=beam)
+        tile['cells'] = merge_cells(simplejson.loads(cells) for cells in
+                                    qs.values_list('cells', flat=True))
+        return tile
+
+    qs = Bestprof.objects.filter(p_bary__gte=lo_p, p_bary__lt=hi_p,
+                                 best_dm__gte=lo_dm, best_dm__lt=hi_dm)
+    if beam is not None:
+        qs = qs.filter(beam=beam)
+    columns = load_columns(qs[:MAX_POINTS + 1], TILE_COLUMNS)
+    if len(columns['pk']) > MAX_POINTS:
+        cells = []
+        for chunk in iter_chunks(qs, TILE_COLUMNS):
+            tiles = bin_tiles(chunk['p_bary'], chunk['best_dm'],
+                              chunk['reduced_chi_sq'], zoom)
+            cells = merge_cells([cells, tiles.get((x, y), [])])
+        tile['cells'] = cells
+    else:
+        tile['points'] = zip(columns['pk'].tolist(),
+                             columns['p_bary'].tolist(),
+                             columns['best_dm'].tolist(),
+                             columns['reduced_chi_sq'].tolist())
+    return tile
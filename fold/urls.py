@@ -1,13 +1,21 @@
 from django.conf.urls import patterns, url
-from django.views.generic.base import TemplateView
 
 from views import BestprofListView, CandidatePHistogramView, ConstraintsView
 from views import CandidatePDMView, CandidatePChiView, ClassifyView
-from views import BestprofDetailView
+from views import BestprofDetailView, CandidateMapView, TileView
+from views import HomeView, BeamSummaryListView, BestprofBatchView
+from views import BulkTagView, CandidateColumnsView
 
 urlpatterns = patterns('',
     url(r'(?P<pk>\d+)/$', BestprofDetailView.as_view(), name='bestprof_detail'),
 #    url(r'(?P<pk>\d+)/tag/', TempView.as_view(), name='bestprof_tag'),
+    url(r'tiles/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.json$',
+        TileView.as_view(), name='candidate_tile'),
+    url(r'api/columns/', CandidateColumnsView.as_view(),
+        name='candidate_columns'),
+    url(r'bulktag/', BulkTagView.as_view(), name='bestprof_bulk_tag'),
+    url(r'batch/', BestprofBatchView.as_view(), name='bestprof_batch'),
+    url(r'pdm/map/', CandidateMapView.as_view(), name='candidate_pdm_map'),
     url(r'pdm/', CandidatePDMView.as_view(), name='candidate_pdm_graph'),
     url(r'pchi/', CandidatePChiView.as_view(), name='candidate_pchi_graph'),
     url(r'phist/', CandidatePHistogramView.as_view(),
@@ -16,7 +24,8 @@ urlpatterns = patterns('',
         name='candidate_constraints'),
     url(r'classify/', ClassifyView.as_view(), name='candidate_classify'),
     # 'Front page'
-    url(r'home/', TemplateView.as_view(template_name='home.html'), name='home'),
+    url(r'home/', HomeView.as_view(), name='home'),
+    url(r'beams/', BeamSummaryListView.as_view(), name='beam_list'),
     url(r'', BestprofListView.as_view(), name='bestprof_list'),
 
 )
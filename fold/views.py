@@ -1,14 +1,25 @@
+import struct
+
 from django.views.generic import ListView
-from django.views.generic.base import TemplateView
+from django.views.generic.base import TemplateView, View
 from django.views.generic.edit import UpdateView
 from django.views.generic.edit import FormView
 from django.core.urlresolvers import reverse
 from django.utils import simplejson
+from django.core.cache import cache
 
 from django.http import HttpResponseRedirect, QueryDict, HttpResponse
+from django.http import StreamingHttpResponse
+from django.http import Http404, HttpResponseBadRequest
+from django.views.decorators.http import condition
 
-from models import Bestprof, FoldedImage
+from models import Bestprof, FoldedImage, BeamSummary, CandidateTag
 from forms import ConstraintsForm, CandidateTagForm
+import pagination
+import caching
+import plotcache
+import tiles
+import columns
 
 OK_GET_PARAMETERS = set([
     'lo_dm',
@@ -41,14 +52,77 @@ def check_parameters(get_pars):
     return qd
 
 
+def stream_pks(qs, order=None, first_chunk=100, max_chunk=10000):
+    '''
+    Yield the primary keys of qs (in the ordering for the order GET
+    parameter, see pagination.ORDERINGS) as lines of JSON lists. The first
+    chunk is small so that clients can start right away, later chunks grow
+    up to max_chunk primary keys.
+
+    Every chunk is a separate LIMIT query after the last row sent (keyset,
+    as in pagination.py), so only one chunk of ids is held in memory.
+    '''
+    ordering = pagination.ORDERINGS.get(
+        order, pagination.ORDERINGS[pagination.DEFAULT_ORDERING])
+    fields = [field for field, _ in ordering]
+    qs = qs.order_by(*[('-' if descending else '') + field
+                       for field, descending in ordering])
+    chunk_size = first_chunk
+    last = None
+    while True:
+        page = qs if last is None else \
+            qs.filter(pagination.seek_filter(ordering, last))
+        rows = list(page.values_list(*fields)[:chunk_size])
+        if not rows:
+            break
+        yield simplejson.dumps([row[fields.index('pk')] for row in rows]) + \
+            '\n'
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1]
+        chunk_size = min(2 * chunk_size, max_chunk)
+
+
+def summary_ranges(get_pars):
+    '''
+    Return the ranges of P, DM and reduced chi-square from the beam
+    summaries if the selection is all candidates (of one beam), else None.
+    '''
+    constraints = check_parameters(get_pars)
+    constraints.pop(u'order', None)
+    beam = constraints.pop(u'beam', [None])[-1]
+    if constraints:
+        return None
+    if beam is None:
+        summary = BeamSummary.objects.totals()
+    else:
+        try:
+            summary = BeamSummary.objects.get(beam=beam)
+        except BeamSummary.DoesNotExist:
+            return None
+    return dict((field, summary.range(field))
+                for field in ['p_bary', 'best_dm', 'reduced_chi_sq'])
+
+
 class BestprofListView(ListView):
     model = Bestprof
     paginate_by = 50
+    # With a cursor GET parameter (may be empty for the first page) pages
+    # are selected by keyset instead of by page number (see pagination.py),
+    # the plot views want the page as a queryset instead of a list.
+    keyset_queryset = False
+    # Load the tags of the candidates on the page.
+    row_tags = True
 
     def dispatch(self, request, *args, **kwargs):
         if request.is_ajax():
             # Shortcut, we just want the primary keys as json.
-            tmp = list(self.get_queryset().values_list('pk', flat=True))
+            qs = self.get_queryset()
+            if u'stream' in request.GET:
+                return StreamingHttpResponse(
+                    stream_pks(qs, request.GET.get(u'order')),
+                    content_type='application/x-ndjson')
+            tmp = list(qs.values_list('pk', flat=True))
             return HttpResponse(simplejson.dumps(tmp, 'application/json'))
         else:
             return super(BestprofListView, self).dispatch(request, *args, **kwargs)
@@ -56,51 +130,167 @@ class BestprofListView(ListView):
     def get_queryset(self):
         return Bestprof.objects.with_constraints(self.request.GET)
 
+    def get_paginator(self, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        signature = caching.constraint_signature(
+            check_parameters(self.request.GET))
+        return caching.CachedCountPaginator(
+            queryset, per_page, signature, orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page)
+
+    def paginate_queryset(self, queryset, page_size):
+        if u'cursor' not in self.request.GET:
+            return super(BestprofListView, self).paginate_queryset(
+                queryset, page_size)
+        try:
+            page = pagination.keyset_page(
+                queryset, self.request.GET.get(u'order'),
+                self.request.GET[u'cursor'], page_size)
+        except ValueError:
+            raise Http404('Invalid cursor.')
+        if self.keyset_queryset:
+            object_list = page.queryset
+        else:
+            object_list = page.object_list
+        return (None, page, object_list, page.has_other_pages())
+
     def get_context_data(self, **kwargs):
         context = super(BestprofListView, self).get_context_data(**kwargs)
         context['selection'] = prepend_questionmark(
             check_parameters(self.request.GET).urlencode())
+        context['keyset'] = u'cursor' in self.request.GET
+        if self.row_tags:
+            # The tags of all rows in one query (see the list template).
+            object_list = list(context['object_list'])
+            tags = CandidateTag.objects.tag_names(
+                [bp.pk for bp in object_list])
+            for bp in object_list:
+                bp.tag_names = tags[bp.pk]
+            context['object_list'] = object_list
+        return context
+
+    def get_extra_page(self):
+        '''
+        Encode the current page (number or cursor) of the plot views, so
+        that the position in the overall list of candidates is retained when
+        switching between the P-DM and P-CHI plots.
+        '''
+        tmp = QueryDict('').copy()
+        page_no = self.request.GET.get(u'page', u'')
+        if page_no:
+            tmp.update({u'page': page_no})
+        if u'cursor' in self.request.GET:
+            tmp.update({u'cursor': self.request.GET[u'cursor']})
+        return tmp.urlencode()
+
+
+class CachedPlotMixin(object):
+    '''
+    Mixin for the plot views, the rendered plot is cached (see plotcache.py)
+    and the pages get an ETag so that browsers can revalidate them.
+    '''
+    plot_kind = None
+    row_tags = False
+
+    def get_plot_key(self):
+        try:
+            return self._plot_key
+        except AttributeError:
+            pass
+        tmp = check_parameters(self.request.GET)
+        for k in [u'page', u'cursor', u'mode', u'shade']:
+            if k in self.request.GET:
+                tmp[k] = self.request.GET[k]
+        self._plot_key = plotcache.plot_key(self.plot_kind, tmp)
+        return self._plot_key
+
+    def get_etag(self, request, *args, **kwargs):
+        # The page shows who is logged in.
+        return '%s-%s' % (self.get_plot_key(), request.user.pk or '')
+
+    def dispatch(self, request, *args, **kwargs):
+        parent = super(CachedPlotMixin, self).dispatch
+        if request.is_ajax():
+            return parent(request, *args, **kwargs)
+        return condition(etag_func=self.get_etag)(parent)(
+            request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(CachedPlotMixin, self).get_context_data(**kwargs)
+        context['plot_cache_key'] = self.get_plot_key()
+        # Same colors on all pages of an unconstrained selection.
+        context['gradient_ranges'] = summary_ranges(self.request.GET)
         return context
 
 
-class CandidatePDMView(BestprofListView):
+class DensityPlotMixin(object):
+    '''
+    Mixin for the scatter plot views, selections of more than
+    density_threshold candidates are shown as a density plot of the whole
+    selection instead of a page of symbols. The mode GET parameter
+    (density or scatter) overrides this, so does asking for a page.
+    '''
+    density_threshold = 2000
+
+    def use_density(self):
+        try:
+            return self._use_density
+        except AttributeError:
+            pass
+        mode = self.request.GET.get(u'mode')
+        if mode in (u'density', u'scatter'):
+            self._use_density = mode == u'density'
+        elif u'page' in self.request.GET or u'cursor' in self.request.GET:
+            self._use_density = False
+        else:
+            signature = caching.constraint_signature(
+                check_parameters(self.request.GET))
+            count = caching.cached_count(self.get_queryset(), signature)
+            self._use_density = count > self.density_threshold
+        return self._use_density
+
+    def get_paginate_by(self, queryset):
+        if self.use_density():
+            return None
+        return super(DensityPlotMixin, self).get_paginate_by(queryset)
+
+    def get_context_data(self, **kwargs):
+        context = super(DensityPlotMixin, self).get_context_data(**kwargs)
+        context['density'] = self.use_density()
+        # Shade the cells by number of candidates or by the maximum of the
+        # quantity that colors the symbols of the scatter plot.
+        context['shade'] = self.request.GET.get(u'shade', u'count')
+        return context
+
+
+class CandidatePDMView(DensityPlotMixin, CachedPlotMixin, BestprofListView):
     template_name = 'fold/pdm_graph.html'
+    plot_kind = 'pdm'
     paginate_by = 2000
+    keyset_queryset = True
 
     def get_context_data(self, **kwargs):
         context = super(CandidatePDMView, self).get_context_data(**kwargs)
-
-        # Add the current plot page to the context (so that the position in
-        # the overall list of candidates is retained when switching from 
-        # P-DM to P-CHI plot).
-        page_no = self.request.GET.get(u'page', u'')
-        if page_no:
-            tmp = QueryDict('').copy()
-            tmp.update({u'page': page_no})
-            context['extra_page'] = tmp.urlencode()
+        context['extra_page'] = self.get_extra_page()
         return context
 
 
-class CandidatePChiView(BestprofListView):
+class CandidatePChiView(DensityPlotMixin, CachedPlotMixin,
+                        BestprofListView):
     template_name = 'fold/pchi_graph.html'
+    plot_kind = 'pchi'
     paginate_by = 2000
+    keyset_queryset = True
 
     def get_context_data(self, **kwargs):
         context = super(CandidatePChiView, self).get_context_data(**kwargs)
-
-        # Add the current plot page to the context (so that the position in
-        # the overall list of candidates is retained when switching from 
-        # P-CHI to P-DM plot).
-        page_no = self.request.GET.get(u'page', u'')
-        if page_no:
-            tmp = QueryDict('').copy()
-            tmp.update({u'page': page_no})
-            context['extra_page'] = tmp.urlencode()
+        context['extra_page'] = self.get_extra_page()
         return context
 
 
-class CandidatePHistogramView(BestprofListView):
+class CandidatePHistogramView(CachedPlotMixin, BestprofListView):
     template_name = 'fold/p_hist.html'
+    plot_kind = 'phist'
     paginate_by = None
 
 
@@ -187,6 +377,167 @@ class BestprofDetailView(UpdateView):
             self.request.GET.urlencode()
 
 
+def candidate_details(pks):
+    '''
+    Return pk, tags and image URL of the candidates with the given primary
+    keys (in that order, unknown ones are left out) in three queries.
+    '''
+    known = set(Bestprof.objects.filter(pk__in=pks).values_list('pk',
+                                                                 flat=True))
+    storage = FoldedImage._meta.get_field('file').storage
+    images = dict(FoldedImage.objects.filter(bestprof__in=known).values_list(
+        'bestprof', 'file'))
+    tags = CandidateTag.objects.tag_names(known)
+    details = []
+    for pk in pks:
+        if pk in known:
+            img = storage.url(images[pk]) if pk in images else None
+            details.append({'pk': pk, 'tags': tags[pk], 'img': img})
+    return details
+
+
+class BestprofBatchView(View):
+    '''
+    Details (see candidate_details) of a batch of candidates as JSON, the
+    primary keys are passed as pks=1,2,3.
+    '''
+    max_batch_size = 100
+
+    def get(self, request, *args, **kwargs):
+        try:
+            pks = [int(pk) for pk in request.GET.get(u'pks', u'').split(u',')
+                   if pk]
+        except ValueError:
+            return HttpResponseBadRequest('Invalid primary keys.')
+        if len(pks) > self.max_batch_size:
+            return HttpResponseBadRequest(
+                'At most %d candidates per batch.' % self.max_batch_size)
+        return HttpResponse(simplejson.dumps(candidate_details(pks)),
+                            content_type='application/json')
+
+
+class BulkTagView(View):
+    '''
+    Add (or with remove=1 remove) a tag for a list of candidates (pks=1,2,3
+    in the POST data) or for the whole selection in the GET parameters.
+    Tagging all candidates needs an explicit all=1.
+    '''
+    def post(self, request, *args, **kwargs):
+        name = request.POST.get(u'tag', u'').strip()
+        if not name:
+            return HttpResponseBadRequest('No tag given.')
+        remove = request.POST.get(u'remove') == u'1'
+
+        if u'pks' in request.POST:
+            try:
+                pks = [int(pk) for pk in request.POST[u'pks'].split(u',')
+                       if pk]
+            except ValueError:
+                return HttpResponseBadRequest('Invalid primary keys.')
+            n_changed = Bestprof.objects.bulk_tag(name, pks=pks,
+                                                  remove=remove)
+        else:
+            constraints = check_parameters(request.GET)
+            constraints.pop(u'order', None)
+            if not constraints and request.POST.get(u'all') != u'1':
+                return HttpResponseBadRequest(
+                    'No candidates selected, pass all=1 to tag all.')
+            qs = Bestprof.objects.with_constraints(constraints)
+            n_changed = Bestprof.objects.bulk_tag(name, qs=qs,
+                                                  remove=remove)
+
+        tmp = {'tag': name, 'removed' if remove else 'added': n_changed}
+        return HttpResponse(simplejson.dumps(tmp),
+                            content_type='application/json')
+
+
+class CandidateColumnsView(View):
+    '''
+    Read-only columnar API. Returns the requested numeric fields
+    (fields=pk,p_bary,best_dm) of a selection (the usual constraints) as one
+    array per field, for up to limit candidates in pk order with a pk larger
+    than after.
+
+    The page is sent in chunks of rows that are each read with one query,
+    so the columns of a chunk always have the same length. With format=json
+    (the default) the response is a JSON object with the fields, dtypes,
+    next (the after for the next page, null on the last page), chunks (each
+    with n_rows and columns, mapping field to array) and the total n_rows.
+    With format=binary the response starts with the fields, dtypes and next
+    as JSON on one line, followed by the chunks, each as its number of rows
+    (packed little-endian int64) followed by the columns in the order of
+    fields as packed little-endian values (dtypes in the header). A chunk
+    of zero rows ends the response.
+    '''
+    default_limit = 1000000
+    max_limit = 10000000
+
+    def get(self, request, *args, **kwargs):
+        dtypes = columns.column_dtypes()
+        fields = [f for f in request.GET.get(u'fields', u'pk').split(u',')
+                  if f]
+        unknown = [f for f in fields if f not in dtypes]
+        if unknown or not fields:
+            return HttpResponseBadRequest(
+                'Unknown fields: %s (available: %s)' % (
+                    ', '.join(unknown), ', '.join(sorted(dtypes))))
+        try:
+            after = request.GET.get(u'after')
+            after = int(after) if after else None
+            limit = int(request.GET.get(u'limit', self.default_limit))
+        except ValueError:
+            return HttpResponseBadRequest('Invalid after or limit.')
+        if not 0 < limit <= self.max_limit:
+            return HttpResponseBadRequest(
+                'Limit must be between 1 and %d.' % self.max_limit)
+        out_format = request.GET.get(u'format', u'json')
+        if out_format not in (u'json', u'binary'):
+            return HttpResponseBadRequest('Format must be json or binary.')
+
+        qs = Bestprof.objects.with_constraints(
+            check_parameters(request.GET))
+        last, more = columns.page_range(qs, after, limit)
+        if after is not None:
+            qs = qs.filter(pk__gt=after)
+        if last is not None:
+            qs = qs.filter(pk__lte=last)
+        header = {
+            'fields': fields,
+            'dtypes': [dtypes[f] for f in fields],
+            'next': last if more else None,
+        }
+
+        def iter_chunks():
+            return columns.iter_chunks(qs, fields, dtypes=dtypes)
+
+        def json_content():
+            yield simplejson.dumps(header)[:-1] + ', "chunks": ['
+            n_rows = 0
+            for i, chunk in enumerate(iter_chunks()):
+                # Python's repr of the floats round trips.
+                yield '%s{"n_rows": %d, "columns": {%s}}' % (
+                    ', ' if i else '', len(chunk['pk']), ', '.join(
+                        '%s: %s' % (simplejson.dumps(field),
+                                    simplejson.dumps(chunk[field].tolist()))
+                        for field in fields))
+                n_rows += len(chunk['pk'])
+            yield '], "n_rows": %d}' % n_rows
+
+        def binary_content():
+            yield simplejson.dumps(header) + '\n'
+            for chunk in iter_chunks():
+                yield struct.pack('<q', len(chunk['pk']))
+                for field in fields:
+                    yield chunk[field].tostring()
+            yield struct.pack('<q', 0)
+
+        if out_format == u'json':
+            return StreamingHttpResponse(json_content(),
+                                         content_type='application/json')
+        return StreamingHttpResponse(binary_content(),
+                                     content_type='application/octet-stream')
+
+
 class ClassifyView(TemplateView):
     template_name = 'fold/classify.html'
 
@@ -202,3 +553,84 @@ class ClassifyView(TemplateView):
         }
 
         return context
+
+
+class TileView(View):
+    '''
+    Serve one tile of the P-DM map as JSON (see tiles.py), optionally for a
+    single beam.
+    '''
+    def get_cache_key(self, request, zoom, x, y):
+        try:
+            return self._cache_key
+        except AttributeError:
+            pass
+        signature = u'%s/%s/%s/%s' % (zoom, x, y, request.GET.get('beam', ''))
+        self._cache_key = caching.cache_key('tile', signature.encode('utf-8'))
+        return self._cache_key
+
+    def dispatch(self, request, *args, **kwargs):
+        parent = super(TileView, self).dispatch
+        return condition(etag_func=self.get_cache_key)(parent)(
+            request, *args, **kwargs)
+
+    def get(self, request, zoom, x, y):
+        zoom, x, y = int(zoom), int(x), int(y)
+        if not tiles.valid_tile(zoom, x, y):
+            raise Http404('No such tile.')
+        key = self.get_cache_key(request, zoom, x, y)
+        content = cache.get(key)
+        if content is None:
+            tile = tiles.get_tile(zoom, x, y, request.GET.get('beam') or None)
+            content = simplejson.dumps(tile)
+            cache.set(key, content, caching.CACHE_TIMEOUT)
+        return HttpResponse(content, content_type='application/json')
+
+
+class CandidateMapView(TemplateView):
+    '''
+    Zoomable map of the P-DM plane, built from tiles in the browser.
+    '''
+    template_name = 'fold/pdm_map.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(CandidateMapView, self).get_context_data(**kwargs)
+        settings = {
+            'tile_url': reverse('candidate_tile', args=[0, 0, 0]).rsplit(
+                '0/0/0.json', 1)[0],
+            'detail_url': reverse('bestprof_detail', args=[0]).rsplit(
+                '0/', 1)[0],
+            'list_url': reverse('bestprof_list'),
+            'log_p_range': tiles.LOG_P_RANGE,
+            'log_dm_range': tiles.LOG_DM_RANGE,
+            'tile_size': tiles.TILE_SIZE,
+            'max_zoom': tiles.MAX_ZOOM,
+            'beam': self.request.GET.get('beam', ''),
+        }
+        context['map_settings'] = simplejson.dumps(settings)
+        context['selection'] = prepend_questionmark(
+            check_parameters(self.request.GET).urlencode())
+        return context
+
+
+class HomeView(TemplateView):
+    template_name = 'home.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(HomeView, self).get_context_data(**kwargs)
+        context['totals'] = BeamSummary.objects.totals()
+        context['n_beams'] = BeamSummary.objects.count()
+        return context
+
+
+class BeamSummaryListView(ListView):
+    '''
+    Overview of all beams, from the beam summaries.
+    '''
+    model = BeamSummary
+    template_name = 'fold/beam_list.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(BeamSummaryListView, self).get_context_data(**kwargs)
+        context['totals'] = BeamSummary.objects.totals()
+        return context
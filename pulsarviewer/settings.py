@@ -162,3 +162,7 @@ LOGGING = {
 }
 
 LOGIN_REDIRECT_URL = '/folds/'
+
+# Directory for the loadbeam checkpoint journals (one file per beam).
+INGEST_JOURNAL_DIR = os.path.join(os.path.split(PROJECTPATH)[0], 'db',
+                                  'journals')